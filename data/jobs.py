@@ -0,0 +1,205 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import jieba
+import numpy as np
+import pandas as pd
+from streamlit import logger
+
+from data.modules import (initialize, warm_up, sync_cache, cachepath, datapath, storage, film_comments, stopwords_service,
+                          WORD_PATTERN, read_tokens, tokens_stale, tokens_cache, render_cloud, cloud_changed,
+                          read_cache, sentiment_stale,
+                          SENTIMENT_LABELS, STAR_SENTIMENT)
+
+# 命令行运行时没有Streamlit会话, 屏蔽缓存装饰器的警告
+logger.set_log_level("error")
+
+
+def run_warmup(args: argparse.Namespace):
+    def progress(done: int, length: int, film: str):
+        if film:
+            print(f"[{done}/{length}] {film}", flush=True)
+
+    s = time.time()
+    count = warm_up(db=args.db, mode=args.force, workers=args.workers, batch=args.batch, progress=progress,
+                    token_workers=args.token_workers)
+    e = time.time()
+    print(f"预热完成: {count}部电影 {(e - s):.2f}s")
+
+
+# 增量同步: 只拉取本地缓存缺少的用户和评论
+def run_sync(args: argparse.Namespace):
+    def progress(done: int, length: int, film: str):
+        if film:
+            print(f"[{done}/{length}] {film}", flush=True)
+
+    s = time.time()
+    synced = sync_cache(db=args.db, workers=args.workers, progress=progress, token_workers=args.token_workers)
+    e = time.time()
+    for film, appended in synced.items():
+        print(f"{film}: " + " ".join(f"{category}+{count}" for category, count in appended.items()))
+    print(f"同步完成: {len(synced)}部电影有新数据 {(e - s):.2f}s")
+
+
+# 停用词过滤基准: 分词只做一次, 比较列表和不可变集合的过滤耗时
+def run_stopwords(args: argparse.Namespace):
+    films = [film for film in os.listdir(cachepath)
+             if storage.exists(film, "短评") and storage.exists(film, "长评")]
+    if not films:
+        print("没有可用的评论缓存, 请先运行 warmup")
+        return
+    # 默认取评论缓存最大的电影
+    film = args.film or max(films, key=lambda _film: os.path.getsize(storage.path(_film, "短评"))
+                            + os.path.getsize(storage.path(_film, "长评")))
+    comments = film_comments(film)
+    s = time.time()
+    words_lists = [jieba.lcut(WORD_PATTERN.sub('', comment)) for comment in comments]
+    e = time.time()
+    print(f"{film}: {len(comments)}条评论 {sum(map(len, words_lists))}个分词, 分词 {(e - s):.2f}s")
+    stopset = stopwords_service.for_film(film)
+    stoplist = list(stopset)
+    timings = {}
+    for name, stopwords in [("list", stoplist), ("frozenset", stopset)]:
+        s = time.time()
+        words = [word for words_list in words_lists for word in words_list if word not in stopwords]
+        timings[name] = time.time() - s
+        print(f"{name:>9}: {len(stopwords)}个停用词 保留{len(words)}个分词 {timings[name]:.4f}s")
+    print(f"加速: {timings['list'] / max(timings['frozenset'], 1e-9):.1f}x")
+
+
+# 单部电影: 词频(过期才重新分词)+渲染, 返回各阶段耗时
+def render_film(film: str) -> tuple:
+    s = time.time()
+    # 已经在进程池的子进程里, 分词不再开嵌套进程池
+    if tokens_stale(film=film):
+        tokens_cache(film=film, workers=1)
+    frequencies = read_tokens(film)
+    t = time.time()
+    render_cloud(film=film, frequencies=frequencies)
+    e = time.time()
+    return film, t - s, e - t
+
+
+# 批量预生成词云: 输入内容没变的电影直接跳过
+def run_clouds(args: argparse.Namespace):
+    films = sorted(film for film in os.listdir(cachepath)
+                   if storage.exists(film, "短评") and storage.exists(film, "长评"))
+    todo = [film for film in films if args.force or cloud_changed(film)]
+    print(f"共{len(films)}部电影, 需要生成{len(todo)}部, 跳过{len(films) - len(todo)}部")
+    timings, failed = [], []
+    s = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(render_film, film): film for film in todo}
+        for done, future in enumerate(as_completed(futures), start=1):
+            try:
+                film, tokenize, render = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"[{done}/{len(todo)}] {futures[future]} 失败: {e}", flush=True)
+                continue
+            timings.append((film, tokenize, render))
+            print(f"[{done}/{len(todo)}] {film} 分词{tokenize:.2f}s 渲染{render:.2f}s", flush=True)
+    e = time.time()
+    print(f"生成完成: 成功{len(timings)}部 失败{len(failed)}部 总耗时{(e - s):.2f}s")
+    if timings:
+        print(f"分词合计{sum(_[1] for _ in timings):.2f}s 渲染合计{sum(_[2] for _ in timings):.2f}s")
+        print("最慢的电影:")
+        for film, tokenize, render in sorted(timings, key=lambda _: _[1] + _[2], reverse=True)[:5]:
+            print(f"  {film}: {(tokenize + render):.2f}s")
+
+
+# 一部电影的短评+长评: 类型, 用户, 评论, star
+def film_reviews(film: str) -> pd.DataFrame:
+    scommsDf = read_cache(film, "短评", columns=["用户", "comment", "star"]).rename(columns={"comment": "评论"})
+    fcommsDf = read_cache(film, "长评", columns=["用户", "full_comment", "star"]).rename(
+        columns={"full_comment": "评论"})
+    return pd.concat([scommsDf.assign(类型="短评"), fcommsDf.assign(类型="长评")], ignore_index=True)
+
+
+# 批量情感预测: 所有需要更新的电影一起分词和预测, 结果写入 cache/电影/情感.parquet
+def run_score(args: argparse.Namespace):
+    model_path = f"{datapath}/keras/saves/{args.model}/{args.model}.keras"
+    if not os.path.isfile(model_path):
+        print(f"没有找到模型: {model_path}")
+        return
+    films = sorted(film for film in os.listdir(cachepath)
+                   if storage.exists(film, "短评") and storage.exists(film, "长评"))
+    todo = [film for film in films if args.force or sentiment_stale(film, args.model, model_path)]
+    print(f"共{len(films)}部电影, 需要预测{len(todo)}部, 跳过{len(films) - len(todo)}部")
+    if not todo:
+        return
+    s = time.time()
+    reviews = pd.concat([film_reviews(film).assign(电影=film) for film in todo], ignore_index=True)
+    t = time.time()
+    print(f"读取{len(reviews)}条评论 {(t - s):.2f}s, 模型: {args.model}", flush=True)
+
+    done = []
+
+    def progress(count: int):
+        done.append(count)
+        print(f"分词 {sum(done)}/{len(reviews)}", flush=True)
+
+    # 先分词再加载tensorflow, 分词进程池启动时进程里还没有tensorflow的线程
+    from data.keras.preprocess import tokenize_comments
+    tokenized = tokenize_comments(reviews["评论"].fillna(""), engine="jieba", workers=args.workers,
+                                  progress=progress)
+    from data.keras.registry import ModelRegistry
+    model = ModelRegistry().get(args.model)
+    probabilities = model.predict_tokenized(tokenized, batch_size=args.batch_size)
+    e = time.time()
+    print(f"预测完成: {len(reviews)}条评论 {(e - t):.2f}s", flush=True)
+    scores = reviews.drop(columns="评论")
+    for i, label in enumerate(SENTIMENT_LABELS):
+        scores[label] = probabilities[:, i]
+    scores["预测"] = np.argmax(probabilities, axis=1)
+    scores["星级情感"] = scores["star"].map(STAR_SENTIMENT)
+    scores["模型"] = args.model
+    for film, group in scores.groupby("电影", sort=False):
+        storage.write(group.drop(columns="电影").reset_index(drop=True), film, "情感")
+    agree = scores.dropna(subset=["星级情感"])
+    print(f"写入{len(todo)}部电影, 与星级一致: {(agree['预测'] == agree['星级情感']).mean() * 100:.2f}% "
+          f"总耗时{(time.time() - s):.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="豆瓣可视化后台任务")
+    jobs = parser.add_subparsers(dest="job", required=True)
+    # 缓存预热
+    warmup = jobs.add_parser("warmup", help="预热全部电影的本地缓存")
+    warmup.add_argument("--db", type=int, default=3, help="数据库")
+    warmup.add_argument("--workers", type=int, default=4, help="并发线程数")
+    warmup.add_argument("--batch", type=int, default=8, help="每个管道包含的电影数")
+    warmup.add_argument("--force", action="store_true", help="强制覆盖")
+    warmup.add_argument("--token-workers", type=int, default=os.cpu_count(), help="分词进程数, 所有线程共用")
+    warmup.set_defaults(func=run_warmup)
+    # 增量同步
+    sync = jobs.add_parser("sync", help="增量同步全部电影的本地缓存")
+    sync.add_argument("--db", type=int, default=3, help="数据库")
+    sync.add_argument("--workers", type=int, default=4, help="并发线程数")
+    sync.add_argument("--token-workers", type=int, default=os.cpu_count(), help="分词进程数, 所有线程共用")
+    sync.set_defaults(func=run_sync)
+    # 停用词过滤基准
+    stopwords = jobs.add_parser("bench-stopwords", help="在评论最多的电影上比较停用词过滤耗时")
+    stopwords.add_argument("--film", default=None, help="指定电影, 默认取评论缓存最大的电影")
+    stopwords.set_defaults(func=run_stopwords)
+    # 词云预生成
+    clouds = jobs.add_parser("clouds", help="多进程预生成全部电影的词云图")
+    clouds.add_argument("--workers", type=int, default=os.cpu_count(), help="进程数")
+    clouds.add_argument("--force", action="store_true", help="忽略内容哈希全部重新生成")
+    clouds.set_defaults(func=run_clouds)
+    # 情感预测
+    score = jobs.add_parser("score", help="用训练好的模型批量预测全部评论的情感")
+    score.add_argument("--model", required=True, help="data/keras/saves下的模型名")
+    score.add_argument("--workers", type=int, default=os.cpu_count(), help="分词进程数")
+    score.add_argument("--batch-size", type=int, default=1024, help="每批预测的评论数")
+    score.add_argument("--force", action="store_true", help="评论和模型没变化也重新预测")
+    score.set_defaults(func=run_score)
+    args = parser.parse_args()
+    initialize()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
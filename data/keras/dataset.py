@@ -0,0 +1,53 @@
+import math
+
+import numpy as np
+import tensorflow as tf
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+# 打乱后按比例划分训练/验证集的序号
+def split_indices(total: int, validation_split: float, seed: int = None) -> tuple:
+    indices = np.random.default_rng(seed).permutation(total)
+    validation = int(total * validation_split)
+    return np.sort(indices[validation:]), np.sort(indices[:validation])
+
+
+# 从内存映射的补全表和标签中按序号取一批, 排序后按磁盘顺序读取
+def _gather(padded: np.ndarray, labels: np.ndarray):
+    def gather(batch: np.ndarray):
+        batch = np.sort(batch)
+        return np.asarray(padded[batch], dtype=np.int32), np.asarray(labels[batch], dtype=np.int32)
+
+    return gather
+
+
+# 训练输入管道: 序号 -> 打乱 -> 分批 -> 并行读取 -> (缓存) -> 预取
+# cache=None 不缓存, "" 缓存到内存, 其他为缓存文件路径
+# 不缓存时每轮重新打乱全部序号; 缓存后每批的组成固定, 只打乱批次顺序
+def make_dataset(padded: np.ndarray, labels: np.ndarray, indices: np.ndarray, batch_size: int,
+                 shuffle: bool = True, cache: str = None, seed: int = None) -> tf.data.Dataset:
+    gather = _gather(padded, labels)
+    max_length = padded.shape[1]
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle and cache is None:
+        dataset = dataset.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).map(
+        lambda batch: tf.numpy_function(gather, [batch], (tf.int32, tf.int32)),
+        num_parallel_calls=AUTOTUNE, deterministic=False)
+    dataset = dataset.map(lambda x, y: (tf.ensure_shape(x, (None, max_length)), tf.ensure_shape(y, (None,))))
+    if cache is not None:
+        dataset = dataset.cache(cache)
+        if shuffle:
+            dataset = dataset.shuffle(math.ceil(len(indices) / batch_size), seed=seed,
+                                      reshuffle_each_iteration=True)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def train_datasets(padded: np.ndarray, labels: np.ndarray, validation_split: float, batch_size: int,
+                   cache: str = None, seed: int = None) -> tuple:
+    train_indices, validation_indices = split_indices(len(padded), validation_split, seed)
+    train = make_dataset(padded, labels, train_indices, batch_size, shuffle=True, cache=cache, seed=seed)
+    validation = make_dataset(padded, labels, validation_indices, batch_size, shuffle=False,
+                              cache=None if cache is None else (cache and f"{cache}.val"))
+    return train, validation
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import jieba
+import numpy as np
+import pandas as pd
+
+# 每个分词任务包含的评论数
+TOKENIZE_CHUNK = 2000
+
+# 补全时每次处理的序列数
+PAD_CHUNK = 100000
+
+# 每个子进程只创建一次thulac分词器
+_thulac = None
+
+
+def cut_comments(comments: list, engine: str = "jieba") -> list:
+    global _thulac
+    if engine == "thulac":
+        if _thulac is None:
+            import thulac
+            _thulac = thulac.thulac(seg_only=True, filt=True)
+        return [_thulac.cut(comment, text=True) for comment in comments]
+    return [' '.join(jieba.cut(comment)) for comment in comments]
+
+
+# 评论分块交给多个进程分词, 每完成一块回调一次进度(评论数)
+def tokenize_comments(comments: pd.Series, engine: str = "jieba", workers: int = 4, progress=None) -> pd.Series:
+    texts = comments.astype(np.str_).tolist()
+    chunks = [texts[i:i + TOKENIZE_CHUNK] for i in range(0, len(texts), TOKENIZE_CHUNK)]
+    if workers <= 1 or len(chunks) <= 1:
+        parts = []
+        for chunk in chunks:
+            parts.append(cut_comments(chunk, engine))
+            if progress:
+                progress(len(chunk))
+    else:
+        parts = [None] * len(chunks)
+        # spawn启动: 调用方是多线程的Streamlit服务(还可能已加载tensorflow), fork可能卡死子进程
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(cut_comments, chunk, engine): i for i, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                i = futures[future]
+                parts[i] = future.result()
+                if progress:
+                    progress(len(chunks[i]))
+    # 按原顺序拼回
+    return pd.Series([word for part in parts for word in part], index=comments.index, dtype=object)
+
+
+# 三分类: 1~2星消极, 3星中性, 4~5星积极
+def sentiment_labels(stars: pd.Series) -> pd.Series:
+    return stars.astype(np.int16).apply(lambda x: 0 if x in [1, 2] else (1 if x == 3 else 2))
+
+
+# 生成tokenized_data.csv的表格: sentiment + tokenized_comment
+def tokenized_frame(data: pd.DataFrame, engine: str = "jieba", workers: int = 4, progress=None) -> pd.DataFrame:
+    tokenized_data = pd.DataFrame()
+    tokenized_data["sentiment"] = sentiment_labels(data["star"])
+    tokenized_data["tokenized_comment"] = tokenize_comments(data["comment"], engine=engine, workers=workers,
+                                                            progress=progress)
+    return tokenized_data
+
+
+# 先写临时文件再替换, 正在被内存映射的旧文件不会被截断
+def save_array(path: str, array: np.ndarray):
+    # 进程+线程区分临时文件, 多个会话同时生成不会写到同一个文件
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+    try:
+        np.save(temp, array)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+# 词汇表能装进uint16就用uint16, 否则int32
+def sequence_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= np.iinfo(np.uint16).max + 1 else np.dtype(np.int32)
+
+
+# 映射表实际能产生的最大序号+1: num_words为None时不限制词汇数
+def tokenizer_vocab_size(tokenizer) -> int:
+    return tokenizer.num_words or len(tokenizer.word_index) + 1
+
+
+# 不定长序列按CSR保存: offsets[i]~offsets[i+1] 是第i条评论在values中的范围
+class RaggedSequences:
+    def __init__(self, offsets: np.ndarray, values: np.ndarray):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    # 等同pad_sequences(padding="post", truncating="post"), 分块直接从values取值
+    def pad(self, maxlen: int) -> np.ndarray:
+        padded = np.zeros((len(self), maxlen), dtype=self.values.dtype)
+        steps = np.arange(maxlen)
+        for start in range(0, len(self), PAD_CHUNK):
+            starts = np.asarray(self.offsets[start:start + PAD_CHUNK + 1])
+            lengths = np.minimum(np.diff(starts), maxlen)
+            mask = steps < lengths[:, None]
+            positions = starts[:-1, None] + steps
+            padded[start:start + len(lengths)][mask] = self.values[positions[mask]]
+        return padded
+
+
+# vocab_size 用编码时映射表的词汇数(tokenizer_vocab_size), 不是页面上的输入
+def save_sequences(path: str, sequences: list, vocab_size: int):
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    values = np.fromiter((token for sequence in sequences for token in sequence),
+                         dtype=np.int64, count=int(offsets[-1]))
+    dtype = sequence_dtype(vocab_size)
+    # 先检查再收窄, 超出范围的序号直接转换会静默回绕
+    if len(values) and values.max() > np.iinfo(dtype).max:
+        raise ValueError(f"序号{values.max()}超出{dtype}范围, 词汇表大小: {vocab_size}")
+    values = values.astype(dtype)
+    save_array(f"{path}/sequences_offsets.npy", offsets)
+    save_array(f"{path}/sequences_values.npy", values)
+
+
+# 只读内存映射, 多个会话共用同一份页缓存
+def load_sequences(path: str) -> RaggedSequences:
+    return RaggedSequences(offsets=np.load(f"{path}/sequences_offsets.npy", mmap_mode="r"),
+                           values=np.load(f"{path}/sequences_values.npy", mmap_mode="r"))
+
+
+def load_padded(path: str) -> np.ndarray:
+    return np.load(f"{path}/padded.npy", mmap_mode="r")
+
+
+# 情感标签和补全表一一对应
+def save_labels(path: str, labels: pd.Series):
+    save_array(f"{path}/labels.npy", labels.to_numpy(dtype=np.int8))
+
+
+def load_labels(path: str) -> np.ndarray:
+    return np.load(f"{path}/labels.npy", mmap_mode="r")
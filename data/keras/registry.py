@@ -0,0 +1,93 @@
+import os
+import pickle
+import threading
+
+import jieba
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.preprocessing.sequence import pad_sequences
+
+from data.keras.preprocess import tokenize_comments
+
+# 部分文件存储位置
+datapath = "./data"
+
+# 类别标签
+LABELS = {0: "消极", 1: "中性", 2: "积极"}
+
+
+# 已加载并预热的模型+映射表
+class SentimentModel:
+    def __init__(self, name: str, model_path: str, tokenizer_path: str):
+        self.name = name
+        self.model = tf.keras.models.load_model(model_path)
+        with open(tokenizer_path, "rb") as file:
+            self.tokenizer = pickle.load(file)
+        self.max_length = self.model.input_shape[1]
+        # Keras模型不保证多个会话同时调用安全
+        self._lock = threading.Lock()
+        # 只预热一次, 触发图构建
+        self.model(np.zeros((1, self.max_length)), training=False)
+
+    @staticmethod
+    def cut(texts: list) -> list:
+        return [jieba.lcut(text) for text in texts]
+
+    # 分词 -> 映射 -> 补全
+    def encode(self, texts: list) -> np.ndarray:
+        sequences = self.tokenizer.texts_to_sequences([' '.join(words) for words in self.cut(texts)])
+        return pad_sequences(sequences, maxlen=self.max_length, padding="post", truncating="post")
+
+    # 返回每条文本三个类别的概率
+    def predict(self, texts: list) -> np.ndarray:
+        padded = self.encode(texts)
+        with self._lock:
+            return self.model(padded, training=False).numpy()
+
+    # 大量文本: 多进程分词, 按batch_size分批预测
+    def predict_batch(self, texts, batch_size: int = 1024, workers: int = 4, progress=None) -> np.ndarray:
+        texts = pd.Series(texts, dtype=object).fillna("")
+        if texts.empty:
+            return np.zeros((0, len(LABELS)), dtype=np.float32)
+        tokenized = tokenize_comments(texts, engine="jieba", workers=workers, progress=progress)
+        return self.predict_tokenized(tokenized, batch_size=batch_size)
+
+    # 已分好词(空格分隔)的文本: 映射 -> 补全 -> 分批预测
+    def predict_tokenized(self, tokenized, batch_size: int = 1024) -> np.ndarray:
+        sequences = self.tokenizer.texts_to_sequences(list(tokenized))
+        if not sequences:
+            return np.zeros((0, len(LABELS)), dtype=np.float32)
+        padded = pad_sequences(sequences, maxlen=self.max_length, padding="post", truncating="post")
+        with self._lock:
+            return self.model.predict(padded, batch_size=batch_size, verbose=0)
+
+
+# 模型注册表: 按(模型名, 文件修改时间)缓存, 重新训练保存后自动重新加载
+class ModelRegistry:
+    def __init__(self, path: str = f"{datapath}/keras/saves", fallback_tokenizer: str = f"{datapath}/keras/tokenizer.pkl"):
+        self.path = path
+        self.fallback_tokenizer = fallback_tokenizer
+        self._lock = threading.Lock()
+        # 模型名 -> (修改时间, 模型)
+        self._models = {}
+
+    def model_path(self, name: str) -> str:
+        return f"{self.path}/{name}/{name}.keras"
+
+    # 优先使用模型自己的映射表, 没有就用全局映射表
+    def tokenizer_path(self, name: str) -> str:
+        path = f"{self.path}/{name}/{name}.pkl"
+        return path if os.path.isfile(path) else self.fallback_tokenizer
+
+    def get(self, name: str) -> SentimentModel:
+        tokenizer_path = self.tokenizer_path(name)
+        mtime = (os.path.getmtime(self.model_path(name)), tokenizer_path, os.path.getmtime(tokenizer_path))
+        with self._lock:
+            cached = self._models.get(name)
+            if cached is None or cached[0] != mtime:
+                cached = self._models[name] = (mtime, SentimentModel(name, self.model_path(name), tokenizer_path))
+            return cached[1]
+
+    def predict(self, name: str, texts: list) -> np.ndarray:
+        return self.get(name).predict(texts)
@@ -1,12 +1,27 @@
+import collections
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
 import random
 import re
+import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
 import jieba
 import numpy as np
 import redis
 
 import pandas as pd
+import pyarrow.parquet as pq
 import streamlit as st
 import plotly.express as px
 from PIL import Image, ImageFont, ImageDraw
@@ -33,12 +48,134 @@ cachepath = "./cache"
 datapath = "./data"
 
 
-# 读取本地缓存文件
-def read_excel(filepath: str):
-    data = pd.read_excel(filepath)
+# 缓存表格的列类型-读取后直接可用, 不用再逐页转换
+FLOAT_COLUMNS = ["star", "hadseen"]
+DATE_COLUMNS = ["date"]
+
+
+def typed_frame(data: pd.DataFrame) -> pd.DataFrame:
+    for column in data.columns.intersection(FLOAT_COLUMNS):
+        if not pd.api.types.is_float_dtype(data[column]):
+            data[column] = pd.to_numeric(data[column], errors="coerce").astype(float)
+    for column in data.columns.intersection(DATE_COLUMNS):
+        if not pd.api.types.is_datetime64_any_dtype(data[column]):
+            data[column] = pd.to_datetime(data[column], errors="coerce")
     return data
 
 
+# 临时文件名带进程号和线程号, 同时写同一个文件也互不覆盖
+# 保留原后缀, xlsx等按后缀判断格式的写入不会出错
+def temp_path(path: str) -> str:
+    root, suffix = os.path.splitext(path)
+    return f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{suffix}"
+
+
+# 先写临时文件再替换, 读取方只会看到完整的旧文件或新文件
+def replace_atomic(path: str, write):
+    temp = temp_path(path)
+    try:
+        write(temp)
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+def write_atomic(path: str, data: bytes):
+    def write(temp: str):
+        with open(temp, 'wb') as f:
+            f.write(data)
+
+    replace_atomic(path, write)
+
+
+def write_json(path: str, data):
+    write_atomic(path, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+
+# 每部电影一把锁: 同一部电影的缓存同时只有一个会话在生成, 其他会话等待后直接读取
+film_locks = {}
+film_locks_lock = threading.Lock()
+
+
+def film_lock(film: str) -> threading.RLock:
+    with film_locks_lock:
+        return film_locks.setdefault(film, threading.RLock())
+
+
+# 本地缓存存储后端 ./cache/电影/名称.后缀
+class CacheStorage:
+    suffix = ""
+
+    def path(self, film: str, name: str) -> str:
+        return f"{cachepath}/{film}/{name}{self.suffix}"
+
+    def exists(self, film: str, name: str) -> bool:
+        return os.path.isfile(self.path(film, name))
+
+    def write(self, data: pd.DataFrame, film: str, name: str):
+        # 缓存文件夹
+        if not os.path.exists(f"{cachepath}/{film}"):
+            os.mkdir(f"{cachepath}/{film}")
+        data = typed_frame(data)
+        replace_atomic(self.path(film, name), lambda temp: self._write(data, temp))
+
+    # columns 只读取需要的列, 表格里没有的列补空
+    def read(self, film: str, name: str, columns: list = None) -> pd.DataFrame:
+        data = self._read(self.path(film, name), columns)
+        if columns:
+            data = data.reindex(columns=columns)
+        return typed_frame(data)
+
+    def _write(self, data: pd.DataFrame, path: str):
+        raise NotImplementedError
+
+    def _read(self, path: str, columns: list = None) -> pd.DataFrame:
+        raise NotImplementedError
+
+
+# 列式存储, 按列读取且保留类型
+class ParquetStorage(CacheStorage):
+    suffix = ".parquet"
+
+    def _write(self, data: pd.DataFrame, path: str):
+        data.to_parquet(path, index=False)
+
+    def _read(self, path: str, columns: list = None) -> pd.DataFrame:
+        if columns:
+            names = pq.read_schema(path).names
+            columns = [column for column in columns if column in names]
+        return pd.read_parquet(path, columns=columns)
+
+
+class ExcelStorage(CacheStorage):
+    suffix = ".xlsx"
+
+    # engine='xlsxwriter' 去除非法字符防止read报错
+    def _write(self, data: pd.DataFrame, path: str):
+        data.to_excel(path, engine='xlsxwriter', index=False)
+
+    def _read(self, path: str, columns: list = None) -> pd.DataFrame:
+        return pd.read_excel(path, usecols=(lambda column: column in columns) if columns else None)
+
+
+storages = {"parquet": ParquetStorage(), "xlsx": ExcelStorage()}
+# 默认缓存格式, xlsx只用于导出
+storage = storages["parquet"]
+
+
+# 读取本地缓存文件
+def read_cache(film: str, name: str, columns: list = None) -> pd.DataFrame:
+    return storage.read(film=film, name=name, columns=columns)
+
+
+# 导出xlsx文件内容
+def export_excel(film: str, name: str) -> bytes:
+    buffer = io.BytesIO()
+    read_cache(film=film, name=name).to_excel(buffer, engine='xlsxwriter', index=False)
+    return buffer.getvalue()
+
+
 def read_txt(filepath: str):
     with open(filepath, mode="r", encoding="utf-8") as file:
         # 要注意回车符号-strip会删除左右的特殊字符-不能为空!
@@ -46,206 +183,908 @@ def read_txt(filepath: str):
     return data
 
 
+# 每个管道最多的命令数, 大批量读取时分块执行
+PIPE_CHUNK = 5000
+
+
+# 批量读取哈希, 分块管道逐条返回: fields为空-HGETALL字典, 否则-HMGET列表
+def hash_records(_r: redis.Redis, keys: list, fields: list = None, chunk: int = PIPE_CHUNK):
+    for start in range(0, len(keys), chunk):
+        pipe = _r.pipeline(transaction=False)
+        for key in keys[start:start + chunk]:
+            if fields:
+                pipe.hmget(key, fields)
+            else:
+                pipe.hgetall(key)
+        yield from pipe.execute()
+
+
+# 按列直接构建DataFrame, 不生成中间的字典列表
+def records_frame(records, fields: list = None) -> pd.DataFrame:
+    columns = {field: [] for field in fields} if fields else {}
+    rows = 0
+    for record in records:
+        items = zip(fields, record) if fields else record.items()
+        for field, value in items:
+            # 新字段之前的行补空
+            columns.setdefault(field, [None] * rows).append(value)
+        rows += 1
+        # 本条缺失的字段补空
+        for values in columns.values():
+            if len(values) < rows:
+                values.append(None)
+    return pd.DataFrame(columns, index=pd.RangeIndex(rows))
+
+
+def fetch_hashes(_r: redis.Redis, keys: list, fields: list = None, chunk: int = PIPE_CHUNK) -> pd.DataFrame:
+    return records_frame(hash_records(_r=_r, keys=keys, fields=fields, chunk=chunk), fields=fields)
+
+
+# 缓存内存上限(MB): 默认值 < .streamlit/secrets.toml的[cache] budget_mb < 环境变量CACHE_BUDGET_MB
+def cache_budget_mb() -> int:
+    budget = 512
+    try:
+        budget = st.secrets["cache"]["budget_mb"]
+    except (FileNotFoundError, KeyError):
+        pass
+    return int(os.environ.get("CACHE_BUDGET_MB", budget))
+
+
+# 估算缓存值占用的字节数
+def estimate_size(value) -> int:
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) \
+            else int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    # 其他对象(图表/字典等)按序列化后的大小估算
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(value)
+
+
+# 所有缓存共用的内存预算, 超出后按最近最少使用淘汰
+class CacheBudget:
+    def __init__(self, budget: int):
+        self.budget = budget
+        # 所有缓存共用一把锁
+        self.lock = threading.RLock()
+        # (缓存, 键) -> 字节数, 顺序即使用顺序
+        self._lru = collections.OrderedDict()
+        self.used = 0
+        self.evictions = 0
+
+    def add(self, cache, key: str, size: int) -> bool:
+        with self.lock:
+            self.remove(cache, key)
+            # 单个值超过预算就不缓存
+            if size > self.budget:
+                return False
+            self._lru[(cache, key)] = size
+            self.used += size
+            self._evict()
+            return True
+
+    def touch(self, cache, key: str):
+        with self.lock:
+            self._lru.move_to_end((cache, key))
+
+    def remove(self, cache, key: str):
+        with self.lock:
+            self.used -= self._lru.pop((cache, key), 0)
+
+    def resize(self, budget: int):
+        with self.lock:
+            self.budget = budget
+            self._evict()
+
+    def _evict(self):
+        while self.used > self.budget and self._lru:
+            (cache, key), size = self._lru.popitem(last=False)
+            self.used -= size
+            cache.discard(key)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"预算(MB)": round(self.budget / 2 ** 20, 1), "已用(MB)": round(self.used / 2 ** 20, 2),
+                    "条目数": len(self._lru), "淘汰次数": self.evictions}
+
+
+cache_budget = CacheBudget(budget=cache_budget_mb() * 2 ** 20)
+
+
+# 进程内缓存: 同一个键同时只有一次加载, 其他请求等待这次的结果
+# 过期后先返回旧值, 同时在后台刷新, 不会所有会话一起去数据库拉取
+# ttl=None 不过期, 只会被内存预算淘汰
+class FlightCache:
+    def __init__(self, name: str, ttl: float = None, budget: CacheBudget = cache_budget):
+        self.name = name
+        self.ttl = ttl
+        self.budget = budget
+        self._lock = budget.lock
+        # 键 -> (值, 加载时间, 字节数)
+        self._entries = {}
+        # 键 -> 正在进行的加载
+        self._flights = {}
+        self.hits = self.misses = self.stales = self.errors = self.loads = self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, key: str, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl is None or time.time() - entry[1] < self.ttl):
+                self.hits += 1
+                self.budget.touch(self, key)
+                return entry[0]
+            flight = self._flights.get(key)
+            if entry is not None:
+                # 过期: 返回旧值, 没有刷新任务就提交一个
+                self.stales += 1
+                self.budget.touch(self, key)
+                if flight is None:
+                    self._flights[key] = refresh_executor.submit(self._load, key, load)
+                return entry[0]
+            self.misses += 1
+            owner = flight is None
+            if owner:
+                flight = self._flights[key] = Future()
+        if owner:
+            try:
+                flight.set_result(self._load(key, load))
+            except Exception as e:
+                flight.set_exception(e)
+        return flight.result()
+
+    def _load(self, key: str, load):
+        start = time.perf_counter()
+        try:
+            value = load()
+        except Exception:
+            with self._lock:
+                self._flights.pop(key, None)
+                self.errors += 1
+            raise
+        # 在锁外估算大小, DataFrame的deep统计比较慢
+        size = estimate_size(value)
+        with self._lock:
+            self._entries[key] = (value, time.time(), size)
+            if not self.budget.add(self, key, size):
+                self._entries.pop(key)
+            self._flights.pop(key, None)
+            self.loads += 1
+            self.load_time += time.perf_counter() - start
+        return value
+
+    # 被预算淘汰
+    def discard(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                self.budget.remove(self, key)
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = sum(entry[2] for entry in self._entries.values())
+            return {"名称": self.name, "命中": self.hits, "未命中": self.misses, "过期返回": self.stales,
+                    "加载次数": self.loads,
+                    "平均加载(ms)": round(self.load_time / self.loads * 1000, 2) if self.loads else None,
+                    "失败": self.errors, "条目数": len(self._entries), "占用(MB)": round(size / 2 ** 20, 2),
+                    "淘汰": self.evictions}
+
+
+# 过期刷新的后台线程
+refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="refresh")
+# 函数名 -> 缓存, 工具页展示统计
+flight_caches = {}
+
+
+# 和st.cache_data一样, 下划线开头的参数(数据库连接等)不参与缓存键
+# 返回值在所有会话共享, 调用方不要原地修改
+def flight_cached(ttl: float = None):
+    def decorator(func):
+        cache = flight_caches[func.__name__] = FlightCache(name=func.__name__, ttl=ttl)
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = {name: value for name, value in bound.arguments.items() if not name.startswith("_")}
+            key = hashlib.sha1(pickle.dumps(arguments)).hexdigest()
+            return cache.get(key, lambda: func(*args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+def flight_stats() -> pd.DataFrame:
+    return pd.DataFrame([cache.stats() for cache in flight_caches.values()])
+
+
 # 返回数据库值
-@st.cache_data(ttl=300)
-def get_value(_r: redis.Redis, key: str):
-    keys = _r.hkeys(key)
-    vals = _r.hvals(key)
-    result = pd.Series(data=list(vals), index=list(keys))
-    return result
-
-
-# 返回大量值
-@st.cache_data(ttl=300)
-def get_values(_r: redis.Redis, keys: list):
-    pipe = _r.pipeline()
-    for key in keys:
-        pipe.hkeys(key)
-        pipe.hvals(key)
-    result = pipe.execute()
-    allkeys = result[0::2]
-    allvals = result[1::2]
-    data = [dict(zip(keys, vals))
-            for keys, vals in zip(allkeys, allvals)]
-    data = pd.DataFrame(data)
-    return data
+@flight_cached(ttl=300)
+def get_value(_r: redis.Redis, key: str, fields: list = None):
+    if fields:
+        return pd.Series(data=_r.hmget(key, fields), index=fields)
+    return pd.Series(_r.hgetall(key), dtype=object)
 
 
-# 返回数据库连接，是不可迭代的，需要cahce_resource
-@st.cache_resource
-def init_connection(db: int):
-    # 连接指定数据库，记得关闭
-    redis_pool = redis.ConnectionPool(
-        host='127.0.0.1',
-        port=6379,
-        password="password",
-        decode_responses=True,
-        db=db)
-    return redis.Redis(connection_pool=redis_pool)
-
-
-# 键值缓存
-@st.cache_data(ttl=600,
-               show_spinner="获取键值中...")
-def keys_table(_r: redis.Redis, allkeys: list):
-    films, users, allshort, allfull = [], [], [], []
-    # key 分类
-    for allkey in allkeys:
-        if "详情" in allkey:
-            films.append(allkey)  # 电影详情key
-        elif "用户" in allkey:
-            users.append(allkey)  # 用户信息key
-        elif "短评" in allkey:
-            allshort.append(allkey)  # 电影短评key
-        elif "长评" in allkey:
-            allfull.append(allkey)  # 电影长评key
-    return films, users, allshort, allfull
-
-
-@st.cache_data(ttl=300)
-def users_df(_r: redis.Redis, userskeys: list):
-    users_dataframe = get_values(_r=_r, keys=userskeys)
-    users_dataframe = users_dataframe.set_index("id")
-    return users_dataframe
-
-
-@st.cache_data(ttl=300)
-def scomms_df(_r: redis.Redis, scommkeys: list):
-    scomms_dataframe = get_values(_r=_r, keys=scommkeys)
-    _cid = [_id.split(" : ")[3] for _id in scommkeys]
-    scomms_dataframe = scomms_dataframe.set_index(pd.Index(_cid).astype(str)).rename_axis("用户")
-    return scomms_dataframe
-
-
-@st.cache_data(ttl=300)
-def fcomms_df(_r: redis.Redis, fcommkeys: list):
-    fcomms_dataframe = get_values(_r=_r, keys=fcommkeys)
-    _cid = [_id.split(" : ")[3] for _id in fcommkeys]
-    fcomms_dataframe = fcomms_dataframe.set_index(pd.Index(_cid).astype(str)).rename_axis("用户")
-    return fcomms_dataframe
-
-
-@st.cache_data(ttl=600, show_spinner="下载键值中...")
-def keys_cache(db: int):
-    with init_connection(db=db) as r:
-        allkeys: list[str] = r.keys()
-        films, users, allshort, allfull = keys_table(_r=r, allkeys=allkeys)
-        # 合并处理
-        keysCache = ['|'.join(films), '|'.join(users), '|'.join(allshort), '|'.join(allfull)]
-        # 缓存文件
-        with open(f"{cachepath}/键值.txt", mode='w', encoding="utf-8") as keysfile:
-            keysfile.write('\n'.join(keysCache))
-    return {"详情": films, "用户": users, "短评": allshort, "长评": allfull}
-
-
-# engine='xlsxwriter' 去除非法字符防止read报错
-@st.cache_data(ttl=300)
+# 返回大量值, fields 只取需要的字段
+@flight_cached(ttl=300)
+def get_values(_r: redis.Redis, keys: list, fields: list = None):
+    return fetch_hashes(_r=_r, keys=keys, fields=fields)
+
+
+# 数据库连接配置: 默认值 < .streamlit/secrets.toml的[redis] < 环境变量REDIS_*
+def redis_config() -> dict:
+    config = {"host": "127.0.0.1", "port": 6379, "password": "password",
+              "max_connections": 50, "timeout": 20}
+    try:
+        config.update(st.secrets["redis"])
+    except (FileNotFoundError, KeyError):
+        pass
+    for name in config:
+        if f"REDIS_{name.upper()}" in os.environ:
+            config[name] = os.environ[f"REDIS_{name.upper()}"]
+    for name in ["port", "max_connections", "timeout"]:
+        config[name] = int(config[name])
+    return config
+
+
+# 带统计的连接池, 连接用尽时阻塞等待而不是报错
+class StatsConnectionPool(redis.BlockingConnectionPool):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.waits = 0
+
+    def get_connection(self, command_name, *keys, **options):
+        # 没有空闲连接且不能再新建时需要等待
+        if self.pool.empty():
+            self.waits += 1
+        return super().get_connection(command_name, *keys, **options)
+
+    def stats(self) -> dict:
+        created = len(self._connections)
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return {"使用中": created - idle, "已创建": created, "最大连接": self.max_connections, "等待次数": self.waits}
+
+
+# 进程内唯一的连接管理, 每个(地址, 数据库, 解码)共用一个连接池, 所有会话线程共享
+class RedisManager:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._config = None
+
+    @property
+    def config(self) -> dict:
+        if self._config is None:
+            self._config = redis_config()
+        return self._config
+
+    def pool(self, db: int, decode: bool = True) -> StatsConnectionPool:
+        config = self.config
+        key = (config["host"], config["port"], db, decode)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = StatsConnectionPool(
+                    host=config["host"],
+                    port=config["port"],
+                    password=config["password"],
+                    max_connections=config["max_connections"],
+                    timeout=config["timeout"],
+                    decode_responses=decode,
+                    db=db)
+            return self._pools[key]
+
+    def stats(self) -> pd.DataFrame:
+        with self._lock:
+            pools = dict(self._pools)
+        return pd.DataFrame([{"地址": f"{host}:{port}", "数据库": db, "解码": decode, **pool.stats()}
+                             for (host, port, db, decode), pool in pools.items()])
+
+
+redis_manager = RedisManager()
+
+
+# 返回数据库连接, 连接池由redis_manager统一管理, 用完不需要关闭
+# decode=False 用于图片等二进制数据
+def init_connection(db: int, decode: bool = True) -> redis.Redis:
+    return redis.Redis(connection_pool=redis_manager.pool(db=db, decode=decode))
+
+
+# 键值分类的匹配模式
+KEY_PATTERNS = {"详情": "电影 : * : 详情",
+                "用户": "电影 : * : 用户 : *",
+                "短评": "电影 : * : 短评 : *",
+                "长评": "电影 : * : 长评 : *"}
+
+
+# SCAN游标遍历, 每次只取一小批, 不会像keys()一样阻塞数据库
+def scan_keys(_r: redis.Redis, match: str = "*", cursor: int = 0, count: int = 1000):
+    while True:
+        cursor, keys = _r.scan(cursor=cursor, match=match, count=count)
+        yield cursor, keys
+        if cursor == 0:
+            break
+
+
+# 键值目录-按类别用SCAN增量遍历, 可以从保存的游标继续
+class KeysCatalog:
+    def __init__(self, r: redis.Redis, patterns: dict = None, count: int = 1000):
+        self.r = r
+        self.patterns = patterns if patterns else KEY_PATTERNS
+        self.count = count
+        # dict去重且保持顺序, SCAN可能返回重复的key
+        self.buckets = {category: {} for category in self.patterns}
+        # None-未开始, 0-遍历完毕, 其他-中断处的游标
+        self.cursors = {category: None for category in self.patterns}
+
+    def done(self, category: str = None) -> bool:
+        categories = [category] if category else self.patterns.keys()
+        return all(self.cursors[_] == 0 for _ in categories)
+
+    def scan(self, category: str, steps: int = None):
+        # steps 限制本次SCAN的次数, 剩余部分下次从游标继续
+        if self.done(category):
+            return
+        cursor = self.cursors[category] or 0
+        for step, (cursor, keys) in enumerate(scan_keys(
+                _r=self.r, match=self.patterns[category], cursor=cursor, count=self.count)):
+            self.buckets[category].update(dict.fromkeys(keys))
+            self.cursors[category] = cursor
+            yield keys
+            if steps and step + 1 >= steps:
+                break
+
+    def scan_all(self) -> dict:
+        for category in self.patterns:
+            for _ in self.scan(category):
+                pass
+        return self.keys()
+
+    def keys(self) -> dict:
+        return {category: list(bucket) for category, bucket in self.buckets.items()}
+
+    # 游标状态保存/读取
+    def save(self, path: str):
+        write_json(path, {"patterns": self.patterns, "cursors": self.cursors, "buckets": self.keys()})
+
+    def load(self, path: str):
+        with open(path, mode='r', encoding="utf-8") as statefile:
+            state = json.load(statefile)
+        # 匹配模式变了游标就没有意义
+        if state["patterns"] != self.patterns:
+            return
+        self.cursors.update(state["cursors"])
+        for category, keys in state["buckets"].items():
+            self.buckets[category].update(dict.fromkeys(keys))
+
+
+# 键值名 电影 : 名称 : 类别 (: id)
+def film_key(film: str, category: str, _id: str = None) -> str:
+    if _id is None:
+        return f"电影 : {film} : {category}"
+    return f"电影 : {film} : {category} : {_id}"
+
+
+# 按电影建立键值索引 {电影: {用户: [id...], 短评: [id...], 长评: [id...]}}
+def keys_index(keysDict: dict) -> dict:
+    index = {key.split(" : ")[1]: {"用户": [], "短评": [], "长评": []}
+             for key in keysDict.get("详情", []) if key}
+    for category in ["用户", "短评", "长评"]:
+        for key in keysDict.get(category, []):
+            if not key:
+                continue
+            _, film, _, _id = key.split(" : ", 3)
+            # 没有详情的电影不收录
+            if film in index:
+                index[film][category].append(_id)
+    return index
+
+
+# 键值清单: gzip压缩的json, 只保存电影名和各类别的id
+# generation-第几次生成, timestamp-生成时间, dbsize-生成时数据库的键数量
+MANIFEST_VERSION = 1
+manifest_path = f"{cachepath}/键值.json.gz"
+
+
+def write_manifest(index: dict, dbsize: int) -> dict:
+    generation = 0
+    if os.path.isfile(manifest_path):
+        try:
+            generation = read_manifest(path=manifest_path, mtime=os.path.getmtime(manifest_path))["generation"]
+        except (OSError, ValueError, KeyError):
+            pass
+    manifest = {"version": MANIFEST_VERSION, "generation": generation + 1,
+                "timestamp": time.time(), "dbsize": dbsize, "films": index}
+    write_atomic(manifest_path, gzip.compress(json.dumps(manifest, ensure_ascii=False).encode("utf-8")))
+    return manifest
+
+
+# 同一个清单对象在所有会话共享, 不做拷贝
+@st.cache_resource(max_entries=1, show_spinner="读取键值清单中...")
+def read_manifest(path: str, mtime: float) -> dict:
+    with gzip.open(path, mode='rt', encoding="utf-8") as file:
+        return json.load(file)
+
+
+# 键值数量和生成时不一致就说明清单过期, 只需要一次DBSIZE
+def manifest_stale(db: int) -> bool:
+    manifest = keys_manifest(_db=db)
+    return init_connection(db=db).dbsize() != manifest["dbsize"]
+
+
+# 用于判断属地 - 常居地 > IP
+LOCATIONS = ["河北", "山西", "辽宁", "吉林", "黑龙江", "江苏",
+             "浙江", "安徽", "福建", "江西", "山东", "河南",
+             "湖北", "湖南", "广东", "海南", "四川", "贵州",
+             "云南", "陕西", "甘肃", "青海", "台湾", "内蒙古",
+             "广西", "西藏", "宁夏", "新疆", "北京", "天津",
+             "上海", "重庆", "香港", "澳门"]
+LOCATION_PATTERN = "(" + "|".join(LOCATIONS) + ")"
+
+
+# 用户属地归一化: IP异常用location填充, 包含省份名的替换为省份, 其他(海外等)保持原样
+def normalize_province(usersDf: pd.DataFrame) -> pd.Series:
+    ip = usersDf["ip"] if "ip" in usersDf else pd.Series(None, index=usersDf.index, dtype=object)
+    # 数据库里缺失的字段是空字符串, parquet会原样保存, 先当作缺失值
+    ip = ip.replace("", np.nan)
+    if "location" in usersDf:
+        ip = ip.fillna(usersDf["location"].replace("", np.nan))
+    # 只对不重复的值做一次正则匹配
+    uniques = pd.Series(ip.dropna().astype(str).unique())
+    provinces = uniques.str.extract(LOCATION_PATTERN, expand=False).fillna(uniques)
+    return ip.map(dict(zip(uniques, provinces)))
+
+
+def keys_cache(db: int) -> dict:
+    r = init_connection(db=db)
+    catalog = KeysCatalog(r=r)
+    # 上次中断的遍历从保存的游标继续
+    if os.path.isfile(f"{cachepath}/键值游标.json"):
+        catalog.load(f"{cachepath}/键值游标.json")
+    try:
+        keysDict = catalog.scan_all()
+    finally:
+        if not catalog.done():
+            catalog.save(f"{cachepath}/键值游标.json")
+    if os.path.isfile(f"{cachepath}/键值游标.json"):
+        os.remove(f"{cachepath}/键值游标.json")
+    # 只保存电影名和id
+    manifest = write_manifest(index=keys_index(keysDict), dbsize=r.dbsize())
+    return {name: manifest[name] for name in ["version", "generation", "timestamp", "dbsize"]}
+
+
+# 写缓存文件的函数直接拉取数据库, 不经过读取缓存, 写入由film_lock保证只有一次
 def infos_cache(db: int, film: str):
-    with init_connection(db=db) as r:
-        # 缓存文件夹
-        if not os.path.exists(f"{cachepath}/{film}"):
-            os.mkdir(f"{cachepath}/{film}")
-        infosDf = get_value(_r=r, key=f"电影 : {film} : 详情")
-        infosDf = infosDf.rename_axis("类别").rename(index="信息")
-        # 缓存文件
-        # 换用xlsxwriter去除非法字符
-        infosDf.to_excel(f"{cachepath}/{film}/详情.xlsx", engine='xlsxwriter')
+    r = init_connection(db=db)
+    infosDf = table_frame("详情", [None], fetch_hashes(_r=r, keys=[film_key(film, "详情")]))
+    # 缓存文件-索引作为普通列保存
+    storage.write(infosDf, film=film, name="详情")
     return infosDf
 
 
-@st.cache_data(ttl=300)
 def users_cache(db: int, film: str, users: list):
-    with init_connection(db=db) as r:
-        # 缓存文件夹
-        if not os.path.exists(f"{cachepath}/{film}"):
-            os.mkdir(f"{cachepath}/{film}")
-        ukeys = [ukey for ukey in users if film in ukey]
-        usersDf = users_df(_r=r, userskeys=ukeys)
-        # 缓存文件
-        usersDf.to_excel(f"{cachepath}/{film}/用户.xlsx", engine='xlsxwriter')
+    r = init_connection(db=db)
+    ukeys = [film_key(film, "用户", _id) for _id in users]
+    usersDf = table_frame("用户", users, fetch_hashes(_r=r, keys=ukeys))
+    # 缓存文件
+    storage.write(usersDf, film=film, name="用户")
     return usersDf
 
 
-@st.cache_data(ttl=300)
 def scomms_cache(db: int, film: str, allshort: list):
-    with init_connection(db=db) as r:
-        # 缓存文件夹
-        if not os.path.exists(f"{cachepath}/{film}"):
-            os.mkdir(f"{cachepath}/{film}")
-        sckeys = [sckey for sckey in allshort if film in sckey]
-        scommsDf = scomms_df(_r=r, scommkeys=sckeys)
-        # 缓存文件
-        scommsDf.to_excel(f"{cachepath}/{film}/短评.xlsx", engine='xlsxwriter')
+    r = init_connection(db=db)
+    sckeys = [film_key(film, "短评", _id) for _id in allshort]
+    scommsDf = table_frame("短评", allshort, fetch_hashes(_r=r, keys=sckeys))
+    # 缓存文件
+    storage.write(scommsDf, film=film, name="短评")
     return scommsDf
 
 
-@st.cache_data(ttl=300)
 def fcomms_cache(db: int, film: str, allfull: list):
-    with init_connection(db=db) as r:
-        # 缓存文件夹
-        if not os.path.exists(f"{cachepath}/{film}"):
-            os.mkdir(f"{cachepath}/{film}")
-        fckeys = [fckey for fckey in allfull if film in fckey]
-        fcommsDf = fcomms_df(_r=r, fcommkeys=fckeys)
-        # 缓存文件
-        fcommsDf.to_excel(f"{cachepath}/{film}/长评.xlsx", engine='xlsxwriter')
+    r = init_connection(db=db)
+    fckeys = [film_key(film, "长评", _id) for _id in allfull]
+    fcommsDf = table_frame("长评", allfull, fetch_hashes(_r=r, keys=fckeys))
+    # 缓存文件
+    storage.write(fcommsDf, film=film, name="长评")
     return fcommsDf
 
 
+# 缓存表格里对应键值id的列
+ID_COLUMNS = {"用户": "id", "短评": "用户", "长评": "用户"}
+
+
+# 本地缓存已有的id
+def cached_ids(film: str, category: str) -> set:
+    column = ID_COLUMNS[category]
+    return set(read_cache(film, category, columns=[column])[column].dropna().astype(str))
+
+
+# 数据库有而本地缓存没有的id, 保持键值清单里的顺序
+def missing_ids(film: str, category: str, keysCache: dict) -> list:
+    cached = cached_ids(film, category)
+    return [_id for _id in keysCache[film][category] if _id not in cached]
+
+
+# 单个类别的缓存状态: fresh-最新, stale-缺少部分数据, missing-没有缓存
+# cached 已读取的本地id, 不传则读取缓存表格
+def cache_status(film: str, category: str, keysCache: dict, cached: set = None) -> str:
+    if not storage.exists(film, category):
+        return "missing"
+    if category != "详情":
+        cached = cached_ids(film, category) if cached is None else cached
+        if any(_id not in cached for _id in keysCache[film][category]):
+            return "stale"
+    return "fresh"
+
+
 # 检查缓存状态-实时更新: 不能st.cache_data
-def checkcache(film: str):
-    def file_with_time(path: str):
-        if os.path.isfile(path=path):
-            return [True, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getctime(path)))]
-        else:
-            return [False, None]
-
-    films_status = file_with_time(f"{cachepath}/{film}/详情.xlsx")
-    users_status = file_with_time(f"{cachepath}/{film}/用户.xlsx")
-    allshort_status = file_with_time(f"{cachepath}/{film}/短评.xlsx")
-    allfull_status = file_with_time(f"{cachepath}/{film}/长评.xlsx")
-    cache_bool_table = {
-        "详情": films_status,
-        "用户": users_status,
-        "短评": allshort_status,
-        "长评": allfull_status
+# 键值清单和数据库的键数量不一致时, 数据库可能有清单里没有的新数据, 本地齐全也算stale
+# {类别: [状态, 缓存时间, 本地条数, 清单条数]}
+def checkcache(db: int, film: str, keysCache: dict):
+    outdated = manifest_stale(db)
+    cache_table = {}
+    for category in ["详情", "用户", "短评", "长评"]:
+        path = storage.path(film, category)
+        # 每个类别的id列只读取一次
+        cached = cached_ids(film, category) if category != "详情" and storage.exists(film, category) else None
+        status = cache_status(film, category, keysCache, cached)
+        if status == "fresh" and outdated and category != "详情":
+            status = "stale"
+        cache_table[category] = [
+            status,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(path))) if status != "missing" else None,
+            None if cached is None else len(cached),
+            None if category == "详情" else len(keysCache[film][category])
+        ]
+    return cache_table
+
+
+# 增量同步单部电影: 只拉取本地缺少的哈希并追加到缓存表格, 返回各类别新增条数
+# token_workers 分词进程数, 只有命令行任务大于1
+def sync_film(db: int, film: str, keysCache: dict, token_workers: int = 1) -> dict:
+    # 和film_cache共用一把锁
+    with film_lock(film):
+        r = init_connection(db=db)
+        appended = {}
+        if not storage.exists(film, "详情"):
+            infos_cache(db=db, film=film)
+            appended["详情"] = 1
+        for category in ["用户", "短评", "长评"]:
+            ids = missing_ids(film, category, keysCache) if storage.exists(film, category) \
+                else keysCache[film][category]
+            if not ids:
+                continue
+            data = table_frame(category=category, ids=ids,
+                               data=fetch_hashes(_r=r, keys=[film_key(film, category, _id) for _id in ids]))
+            if storage.exists(film, category):
+                data = pd.concat([read_cache(film, category), data], ignore_index=True)
+            storage.write(data, film=film, name=category)
+            appended[category] = len(ids)
+        # 有新数据才重新汇总
+        if appended or not os.path.isfile(f"{cachepath}/{film}/统计.json"):
+            aggregates_cache(film=film)
+        if appended or tokens_stale(film=film):
+            tokens_cache(film=film, workers=token_workers)
+        return appended
+
+
+# 增量同步全部电影: 键值清单过期先重新扫描, 再并发同步
+# progress(已完成数, 总数, 电影名) 每完成一部电影回调一次
+def sync_cache(db: int, workers: int = 4, progress=None, token_workers: int = 1) -> dict:
+    if manifest_stale(db=db):
+        keys_cache(db=db)
+    keysCache = get_keysCache(_db=db)
+    films, synced = list(keysCache), {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sync_film, db, film, keysCache, token_workers): film for film in films}
+        for done, future in enumerate(as_completed(futures), start=1):
+            appended = future.result()
+            if appended:
+                synced[futures[future]] = appended
+            if progress:
+                progress(done, len(films), futures[future])
+    return synced
+
+
+# 星级映射, -1(未评分)按1星处理
+STAR_LABELS = {1.0: "很差", 2.0: "较差", 3.0: "还行", 4.0: "推荐", 5.0: "力荐"}
+
+
+# 精选评论: 第一条5星评论, maxlen限制评论长度
+def featured_comment(commsDf: pd.DataFrame, maxlen: int = None):
+    # 空表读出来的列全是NaN, 不能用.str
+    if commsDf.empty:
+        return None
+    chosen = commsDf[commsDf["star"] == 5.0]
+    if maxlen:
+        chosen = chosen[chosen["comment"].astype(str).str.len() < maxlen]
+    if chosen.empty:
+        return None
+    # 缺失值转成None, NaN写进json是非法的, 页面上也会显示成nan
+    row = {key: None if pd.isna(value) else value for key, value in chosen.iloc[0].items()}
+    # 日期列读出来是时间类型, 只显示日期
+    date = row["date"].strftime("%Y-%m-%d") if isinstance(row["date"], pd.Timestamp) else row["date"]
+    return {"comment": row["comment"], "用户": row["用户"], "date": date and str(date), "homepage": row["homepage"]}
+
+
+# 单部电影的图表汇总, 随缓存一起生成, 分析页只需要读取这几KB
+def aggregates_cache(film: str) -> dict:
+    usersDf = read_cache(film, "用户", columns=["id", "province", "jointime", "hadseen"])
+    usersDf = usersDf.dropna(axis=0, how="any", subset=["province"])
+    scommsDf = read_cache(film, "短评", columns=["用户", "comment", "date", "star", "homepage"])
+    fcommsDf = read_cache(film, "长评", columns=["用户", "full_comment", "date", "star", "homepage"])
+    fcommsDf = fcommsDf.rename(columns={"full_comment": "comment"})
+    stars = scommsDf["star"].replace(-1.0, 1.0).map(STAR_LABELS).dropna()
+    aggregates = {
+        "地域": usersDf["province"].astype(str).value_counts().to_dict(),
+        "星级": stars.value_counts().to_dict(),
+        "散点": {
+            "ID": usersDf["id"].astype(str).to_list(),
+            "IP": usersDf["province"].astype(str).to_list(),
+            "加入年份": usersDf["jointime"].astype(str).to_list(),
+            "看过电影": usersDf["hadseen"].fillna(0).to_list()
+        },
+        "评论数": {"用户": len(usersDf), "短评": len(scommsDf), "长评": len(fcommsDf)},
+        "精选": {"短评": featured_comment(scommsDf), "长评": featured_comment(fcommsDf, maxlen=200)}
     }
-    return cache_bool_table
+    write_json(f"{cachepath}/{film}/统计.json", aggregates)
+    return aggregates
+
+
+# 文件修改时间参与缓存, 重新生成后自动更新
+@flight_cached()
+def load_aggregates(path: str, mtime: float) -> dict:
+    with open(path, mode='r', encoding="utf-8") as file:
+        return json.load(file)
+
+
+def read_aggregates(film: str) -> dict:
+    path = f"{cachepath}/{film}/统计.json"
+    return load_aggregates(path=path, mtime=os.path.getmtime(path))
+
+
+# 情感三分类: 1~2星消极, 3星中性, 4~5星积极
+SENTIMENT_LABELS = ["消极", "中性", "积极"]
+STAR_SENTIMENT = {1.0: 0, 2.0: 0, 3.0: 1, 4.0: 2, 5.0: 2}
+
+
+# 情感预测不是这个模型生成的, 或者比评论缓存、模型旧就失效
+def sentiment_stale(film: str, model: str, model_path: str) -> bool:
+    if not storage.exists(film, "情感"):
+        return True
+    if set(storage.read(film, "情感", columns=["模型"])["模型"].dropna()) != {model}:
+        return True
+    sources = [storage.path(film, "短评"), storage.path(film, "长评"), model_path]
+    mtime = os.path.getmtime(storage.path(film, "情感"))
+    return any(os.path.getmtime(source) > mtime for source in sources if os.path.isfile(source))
+
+
+# 模型预测和星级的情感分布对比, 返回(分布表, 模型名)
+@flight_cached()
+def load_sentiment(film: str, mtime: float) -> tuple:
+    scores = storage.read(film, "情感")
+    predicted = scores["预测"].map(dict(enumerate(SENTIMENT_LABELS))).value_counts()
+    stars = scores["星级情感"].dropna().map(dict(enumerate(SENTIMENT_LABELS))).value_counts()
+    summary = pd.DataFrame({"模型预测": predicted, "星级": stars}).reindex(SENTIMENT_LABELS).fillna(0) \
+        .astype(int).rename_axis("情感")
+    models = scores["模型"].dropna().unique()
+    return summary, ", ".join(map(str, models))
+
+
+# 没有运行过 score 任务时返回None
+def read_sentiment(film: str):
+    if not storage.exists(film, "情感"):
+        return None
+    return load_sentiment(film=film, mtime=os.path.getmtime(storage.path(film, "情感")))
 
 
 def film_cache(_db: int, film: str, keysCache: dict, mode: bool):
-    if not mode:
-        if not os.path.isfile(f"{cachepath}/{film}/详情.xlsx"):
+    # 拿到锁后再检查文件, 等待的会话会发现缓存已经生成
+    with film_lock(film):
+        # mode=True 强制覆盖, 否则只补齐缺失的表格
+        built = False
+        if mode or not storage.exists(film, "详情"):
             infos_cache(db=_db, film=film)
-        if not os.path.isfile(f"{cachepath}/{film}/用户.xlsx"):
-            users_cache(db=_db, film=film, users=keysCache["用户"])
-        if not os.path.isfile(f"{cachepath}/{film}/短评.xlsx"):
-            scomms_cache(db=_db, film=film, allshort=keysCache["短评"])
-        if not os.path.isfile(f"{cachepath}/{film}/长评.xlsx"):
-            fcomms_cache(db=_db, film=film, allfull=keysCache["长评"])
-    else:
-        infos_cache(db=_db, film=film)
-        users_cache(db=_db, film=film, users=keysCache["用户"])
-        scomms_cache(db=_db, film=film, allshort=keysCache["短评"])
-        fcomms_cache(db=_db, film=film, allfull=keysCache["长评"])
+            built = True
+        if mode or not storage.exists(film, "用户"):
+            users_cache(db=_db, film=film, users=keysCache[film]["用户"])
+            built = True
+        if mode or not storage.exists(film, "短评"):
+            scomms_cache(db=_db, film=film, allshort=keysCache[film]["短评"])
+            built = True
+        if mode or not storage.exists(film, "长评"):
+            fcomms_cache(db=_db, film=film, allfull=keysCache[film]["长评"])
+            built = True
+        # 表格有更新就重新汇总
+        if built or not os.path.isfile(f"{cachepath}/{film}/统计.json"):
+            aggregates_cache(film=film)
+        if built or tokens_stale(film=film):
+            # 页面线程里不fork进程池, 持有film_lock时子进程可能卡在其他线程的锁上
+            tokens_cache(film=film, workers=1)
+
+
+# 缓存表格统一格式: 详情-类别/信息, 用户-id列在前, 评论-用户列在前
+def table_frame(category: str, ids: list, data: pd.DataFrame) -> pd.DataFrame:
+    if category == "详情":
+        return (data.iloc[0] if len(data) else pd.Series(dtype=object)) \
+            .rename_axis("类别").rename("信息").reset_index()
+    if data.empty:
+        return data
+    if category == "用户":
+        data["province"] = normalize_province(data)
+        return data.set_index("id").reset_index()
+    return data.set_index(pd.Index(ids).astype(str)).rename_axis("用户").reset_index()
+
+
+# 一批电影的HGETALL合并到同一组管道, 拉取后逐部写入缓存
+def warm_batch(_r: redis.Redis, films: list, keysCache: dict, names: dict, token_workers: int = 1) -> list:
+    keys, plan = [], []
+    for film in films:
+        for name in names[film]:
+            ids = [None] if name == "详情" else keysCache[film][name]
+            keys.extend(film_key(film, name, _id) for _id in ids)
+            plan.append((film, name, ids))
+    records = hash_records(_r=_r, keys=keys)
+    # plan按电影顺序排列, 逐部电影加锁写入
+    for film, group in itertools.groupby(plan, key=lambda step: step[0]):
+        with film_lock(film):
+            for _, name, ids in group:
+                data = records_frame(itertools.islice(records, len(ids)))
+                storage.write(table_frame(category=name, ids=ids, data=data), film=film, name=name)
+    # 表格齐全后汇总, 分词进程池只在命令行任务里使用
+    for film in films:
+        with film_lock(film):
+            aggregates_cache(film=film)
+            tokens_cache(film=film, workers=token_workers)
+    return films
+
+
+# 批量预热缓存: workers-并发线程数, batch-每个管道包含的电影数
+# progress(已完成数, 总数, 电影名) 每完成一部电影回调一次
+def warm_up(db: int, mode: bool = False, workers: int = 4, batch: int = 8, progress=None,
+            token_workers: int = 1) -> int:
+    keysCache = get_keysCache(_db=db)
+    # mode=True 强制覆盖, 否则只处理缺失的表格
+    names = {film: [name for name in ["详情", "用户", "短评", "长评"]
+                    if mode or not storage.exists(film, name)]
+             for film in keysCache}
+    todo = [film for film in keysCache
+            if names[film] or not os.path.isfile(f"{cachepath}/{film}/统计.json") or tokens_stale(film=film)]
+    length, done = len(keysCache), len(keysCache) - len(todo)
+    if progress:
+        progress(done, length, None)
+    r = init_connection(db=db)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(warm_batch, r, todo[i:i + batch], keysCache, names, token_workers)
+                   for i in range(0, len(todo), batch)]
+        for future in as_completed(futures):
+            for film in future.result():
+                done += 1
+                if progress:
+                    progress(done, length, film)
+    return len(todo)
 
 
 # 缓存大部分表格
-def all_cache(_db: int, _mode: bool):
-    # 获取所有键值
-    _keysCache = get_keysCache(_db=_db)
+def all_cache(_db: int, _mode: bool, _workers: int = 4):
     with st.sidebar:
         holder = st.empty()
-        length = len(_keysCache["详情"])
-        holder.progress(value=0, text=f"处理进度: 0/{length}")
-        for _index, keys in enumerate(_keysCache["详情"]):
-            holder.progress(value=(_index + 1) / length, text=f"处理进度: {_index + 1}/{length}")
-            _film = keys.split(" : ")[1]  # 电影名
-            film_cache(_db=_db, film=_film, keysCache=_keysCache, mode=_mode)
+
+        def progress(done: int, length: int, film: str):
+            holder.progress(value=done / length if length else 1.0,
+                            text=f"处理进度: {done}/{length}" + (f" - {film}" if film else ""))
+
+        warm_up(db=_db, mode=_mode, workers=_workers, progress=progress)
+        holder.empty()
+
+
+# 增量同步全部电影
+def all_sync(_db: int, _workers: int = 4) -> dict:
+    with st.sidebar:
+        holder = st.empty()
+
+        def progress(done: int, length: int, film: str):
+            holder.progress(value=done / length if length else 1.0,
+                            text=f"同步进度: {done}/{length}" + (f" - {film}" if film else ""))
+
+        synced = sync_cache(db=_db, workers=_workers, progress=progress)
         holder.empty()
+    return synced
 
 
-@st.cache_data(show_spinner="散点图生成中...")
+# 封面: 原图给详情栏, WebP缩略图给首页的封面网格
+THUMB_SIZE = (240, 360)
+# 每个管道拉取的封面数
+COVER_CHUNK = 50
+
+
+def cover_path(film: str) -> str:
+    return f"{cachepath}/{film}/images/cover.jpg"
+
+
+def thumb_path(film: str) -> str:
+    return f"{cachepath}/{film}/images/thumb.webp"
+
+
+# 保存单个封面, 内容哈希没变就不重写, 返回是否写入
+def save_cover(film: str, image: bytes) -> bool:
+    digest = hashlib.sha256(image).hexdigest()
+    hash_path = f"{cachepath}/{film}/images/cover.sha256"
+    if os.path.isfile(cover_path(film)) and os.path.isfile(thumb_path(film)) and os.path.isfile(hash_path):
+        with open(hash_path, mode='r', encoding="utf-8") as f:
+            if f.read().strip() == digest:
+                return False
+    os.makedirs(f"{cachepath}/{film}/images", exist_ok=True)
+    # 缩略图解码缩放
+    thumb = Image.open(io.BytesIO(image))
+    thumb.thumbnail(THUMB_SIZE)
+    buffer = io.BytesIO()
+    thumb.convert("RGB").save(buffer, format="WEBP", quality=80)
+    write_atomic(cover_path(film), image)
+    write_atomic(thumb_path(film), buffer.getvalue())
+    write_atomic(hash_path, digest.encode("utf-8"))
+    return True
+
+
+# 拉取封面并生成缩略图: mode=True 重新拉取全部, 内容没变的仍然跳过写入
+def covers_cache(db: int, films: list, mode: bool = False, workers: int = 4) -> int:
+    todo = [film for film in films
+            if mode or not (os.path.isfile(cover_path(film)) and os.path.isfile(thumb_path(film)))]
+    if not todo:
+        return 0
+    # 图片二进制不需要解码
+    r = init_connection(db=db, decode=False)
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # 拉取下一块的同时, 线程池处理已经拉到的封面
+        for i in range(0, len(todo), COVER_CHUNK):
+            chunk = todo[i:i + COVER_CHUNK]
+            pipe = r.pipeline(transaction=False)
+            for film in chunk:
+                pipe.get(f"电影 : {film} : 图片")
+            # 缺失封面的电影跳过
+            futures.extend(executor.submit(save_cover, film, image)
+                           for film, image in zip(chunk, pipe.execute()) if image)
+        return sum(future.result() for future in futures)
+
+
+# 后台预取封面, 同一批电影同时只提交一次
+cover_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cover")
+cover_lock = threading.Lock()
+cover_futures = {}
+
+
+def prefetch_covers(db: int, films: list, workers: int = 4):
+    if not films:
+        return None
+    key = (db, tuple(films))
+    with cover_lock:
+        # 清理已完成的任务
+        for done in [_ for _, future in cover_futures.items() if future.done()]:
+            cover_futures.pop(done)
+        if key not in cover_futures:
+            cover_futures[key] = cover_executor.submit(covers_cache, db, films, False, workers)
+        return cover_futures[key]
+
+
+@flight_cached()
 def point_chart_module(data: pd.DataFrame):
     fig = px.scatter(
         data,
@@ -262,7 +1101,7 @@ def point_chart_module(data: pd.DataFrame):
     return fig
 
 
-@st.cache_data(show_spinner="饼图生成中...")
+@flight_cached()
 def pie_chart_module(data: pd.DataFrame, titles: str):
     # 使用altair创建饼图
     column_name = data.columns[0]
@@ -280,61 +1119,346 @@ def pie_chart_module(data: pd.DataFrame, titles: str):
     return fig
 
 
-@st.cache_data(show_spinner="字符过滤中...")
-def word_filter(comstring: str, name: str, stopwords: list):
-    # 评论处理
-    pattern = re.compile(r"[^\u4e00-\u9fa5^a-zA-Z]")  # 滤除非中英文字符
-    word_string = pattern.sub('', comstring)
-    # jieba分词
-    words_list = jieba.lcut(word_string)
-    # 筛选掉停用词 电影本名也加入停用
-    stopwords.append(name)
-    stopwords.extend(jieba.lcut(name))
-    _words = [word for word in words_list
-              if word not in stopwords]
-    return _words
-
-
-# 词云处理
-@st.cache_data(show_spinner="词云图生成中...")
-def word_clouds(words: list, hotwords: list):
-    keywords = ' '.join(words)
-    # 生成整个电影数据集的词云图
-    font_path = f"{datapath}/fonts/LXGWWenKai-Regular.ttf"
-    # 取第一个高频的中文词
-    text = hotwords[0][0]
-    pattern = re.compile(r"[\u4e00-\u9fa5]")
-    for hotword in hotwords:
-        if re.match(pattern, hotword[0]):
-            text = hotword[0]
-            break
-    # 字体大小
-    size = 1000
+@flight_cached()
+def bar_chart_module(data: pd.DataFrame, titles: str):
+    # 分组柱状图, 每列一组
+    fig = px.bar(
+        data,
+        barmode="group",
+        title=titles)
+    fig.update_layout(yaxis_title="数目", legend_title=None)
+    return fig
+
+
+# 滤除非中英文字符
+WORD_PATTERN = re.compile(r"[^\u4e00-\u9fa5^a-zA-Z]")
+# 每个分词任务包含的评论数
+TOKENS_CHUNK = 2000
+
+
+# 停用词服务: 停用词文件只在变化后读取一次, 保存为不可变集合
+# 基础表 new_stopwords.txt + 工具页维护的 user_stopwords.txt
+class StopwordsService:
+    def __init__(self, paths: list, user_path: str):
+        self.paths = paths
+        self.user_path = user_path
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._words = frozenset()
+        # 电影名 -> 加入电影本名后的停用词集合
+        self._films = {}
+
+    def mtimes(self) -> tuple:
+        return tuple(os.path.getmtime(path) if os.path.isfile(path) else None for path in self.paths)
+
+    def words(self) -> frozenset:
+        mtimes = self.mtimes()
+        if mtimes != self._mtimes:
+            with self._lock:
+                if mtimes != self._mtimes:
+                    words = set()
+                    for path in self.paths:
+                        if os.path.isfile(path):
+                            words.update(word for word in read_txt(path) if word)
+                    self._words = frozenset(words)
+                    self._films = {}
+                    self._mtimes = mtimes
+        return self._words
+
+    # 单部电影的停用词: 电影本名及其分词也加入停用, 不修改共享的集合
+    def for_film(self, film: str, extra: tuple = ()) -> frozenset:
+        words = self.words()
+        if extra:
+            return words | {film} | set(jieba.lcut(film)) | set(extra)
+        if film not in self._films:
+            self._films[film] = words | {film} | set(jieba.lcut(film))
+        return self._films[film]
+
+    def user_words(self) -> list:
+        return [word for word in read_txt(self.user_path) if word] if os.path.isfile(self.user_path) else []
+
+    # 覆盖保存用户停用词, 去重并保持顺序
+    def save_user_words(self, words: list):
+        words = list(dict.fromkeys(word.strip() for word in words if word.strip()))
+        write_atomic(self.user_path, '\n'.join(words).encode("utf-8"))
+
+    def stats(self) -> dict:
+        return {"停用词": len(self.words()), "用户停用词": len(self.user_words())}
+
+
+stopwords_service = StopwordsService(paths=[f"{datapath}/new_stopwords.txt", f"{datapath}/user_stopwords.txt"],
+                                     user_path=f"{datapath}/user_stopwords.txt")
+
+
+# 逐条评论分词并计数, 进程池任务需要是模块级函数
+def count_words(comments: list, stopwords: frozenset) -> collections.Counter:
+    counts = collections.Counter()
+    for comment in comments:
+        counts.update(word for word in jieba.lcut(WORD_PATTERN.sub('', comment))
+                      if word not in stopwords)
+    return counts
+
+
+# 分词进程池: 命令行任务里多部电影共用, 只启动一次
+# spawn启动, 不会在多线程的进程里fork出卡在别的线程锁上的子进程
+@functools.lru_cache(maxsize=None)
+def token_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+# 分词+词频统计, workers>1时评论分块交给进程池
+# 页面请求路径上保持workers=1
+def word_filter(comments: list, stopwords: frozenset, workers: int = 1) -> collections.Counter:
+    chunks = [comments[i:i + TOKENS_CHUNK] for i in range(0, len(comments), TOKENS_CHUNK)]
+    if workers <= 1 or len(chunks) <= 1:
+        return count_words(comments, stopwords)
+    counts = collections.Counter()
+    for part in token_pool(workers).map(count_words, chunks, itertools.repeat(stopwords)):
+        counts.update(part)
+    return counts
+
+
+# 词频比评论缓存或停用词文件旧就失效
+def tokens_stale(film: str) -> bool:
+    path = f"{cachepath}/{film}/词频.json"
+    if not os.path.isfile(path):
+        return True
+    sources = [storage.path(film, "短评"), storage.path(film, "长评")] + stopwords_service.paths
+    mtime = os.path.getmtime(path)
+    return any(os.path.getmtime(source) > mtime for source in sources if os.path.isfile(source))
+
+
+# 单部电影的词频, 随缓存一起生成 ./cache/电影/词频.json
+# 单部电影的全部短评和长评内容
+def film_comments(film: str) -> list:
+    return read_cache(film, "短评", columns=["comment"])["comment"].dropna().astype(str).to_list() \
+        + read_cache(film, "长评", columns=["full_comment"])["full_comment"].dropna().astype(str).to_list()
+
+
+def tokens_cache(film: str, workers: int = 1) -> dict:
+    comments = film_comments(film)
+    counts = word_filter(comments=comments, stopwords=stopwords_service.for_film(film), workers=workers)
+    # 按频次排好序保存, 前几项就是高频词
+    tokens = dict(counts.most_common())
+    write_json(f"{cachepath}/{film}/词频.json", tokens)
+    return tokens
+
+
+@flight_cached()
+def load_tokens(path: str, mtime: float) -> dict:
+    with open(path, mode='r', encoding="utf-8") as file:
+        return json.load(file)
+
+
+# 读取词频, 缺失或过期时重新统计
+def read_tokens(film: str) -> dict:
+    path = f"{cachepath}/{film}/词频.json"
+    if tokens_stale(film=film):
+        with st.spinner("分词统计中..."), film_lock(film):
+            # 等待期间可能已经被其他会话统计好了
+            if tokens_stale(film=film):
+                # 同film_cache, 请求路径上单进程分词
+                tokens_cache(film=film, workers=1)
+    return load_tokens(path=path, mtime=os.path.getmtime(path))
+
+
+# 词云字体: 词语字体, 背景文字字体
+CLOUD_FONT = f"{datapath}/fonts/LXGWWenKai-Regular.ttf"
+MASK_FONT = f"{datapath}/fonts/HanYiChaoCuHeiJian-1.ttf"
+
+
+# 字体按(路径, 字号)缓存, 不用每张词云都重新加载
+@functools.lru_cache(maxsize=32)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, size)
+
+
+# 词云背景遮罩按(文字, 尺寸)缓存, 只读防止被修改
+@functools.lru_cache(maxsize=32)
+def cloud_mask(text: str, size: int) -> np.ndarray:
     # 背景图画布颜色
     background = Image.new("RGB", (int(size * 1.1), size), (255, 255, 255))
     dr = ImageDraw.Draw(background)
     # 字体样式
-    font = ImageFont.truetype(
-        f"{datapath}/fonts/HanYiChaoCuHeiJian-1.ttf",
-        int(size / len(text)))
+    font = load_font(MASK_FONT, int(size / len(text)))
     # 文字颜色
     dr.text((size * 0.1 / 2, (size - size / len(text)) / 2), text, font=font, fill="#000000")
     # 加载背景图
     graph = np.array(background)
+    graph.setflags(write=False)
+    return graph
+
+
+# 词云处理 frequencies-按频次排好序的词频字典
+def word_clouds(frequencies: dict) -> Image.Image:
+    # 生成整个电影数据集的词云图
+    # 取第一个高频的中文词
+    hotwords = list(frequencies)[:20]
+    text = hotwords[0]
+    pattern = re.compile(r"[\u4e00-\u9fa5]")
+    for hotword in hotwords:
+        if re.match(pattern, hotword):
+            text = hotword
+            break
+    # 字体大小
+    size = 1000
     # 生成词云
     wordcloud = WordCloud(
         width=int(size * 1.1),
         height=size,
-        font_path=font_path,
+        font_path=CLOUD_FONT,
         background_color="white",
-        mask=graph,
+        mask=cloud_mask(text, size),
         colormap=random.choice(["copper", "autumn", "summer", "winter", "cividis", None])
-    ).generate(keywords)  # 使用筛选后的关键词生成词云
+    ).generate_from_frequencies(frequencies)  # 直接使用统计好的词频生成词云
     # 转化为图片数据
     wcImage = wordcloud.to_image()
     return wcImage
 
 
+def cloud_path(film: str) -> str:
+    return f"{cachepath}/{film}/词云.png"
+
+
+# 词云比词频旧就需要重新生成
+def cloud_stale(film: str) -> bool:
+    path, tokens = cloud_path(film), f"{cachepath}/{film}/词频.json"
+    if not os.path.isfile(path):
+        return True
+    return os.path.isfile(tokens) and os.path.getmtime(tokens) > os.path.getmtime(path)
+
+
+# 单个文件的内容哈希, 按修改时间缓存, 字体等大文件不用重复计算
+@functools.lru_cache(maxsize=1024)
+def file_hash(path: str, mtime: float) -> str:
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 词云输入的内容哈希: 评论缓存+停用词+字体, 不存在的文件也参与
+def cloud_digest(film: str) -> str:
+    digest = hashlib.sha256()
+    for path in [storage.path(film, "短评"), storage.path(film, "长评")] + stopwords_service.paths \
+            + [CLOUD_FONT, MASK_FONT]:
+        digest.update(f"{os.path.basename(path)}:".encode("utf-8"))
+        digest.update(file_hash(path, os.path.getmtime(path)).encode() if os.path.isfile(path) else b"-")
+    return digest.hexdigest()
+
+
+# 输入内容有变化或还没有词云时需要重新生成
+def cloud_changed(film: str) -> bool:
+    path = f"{cachepath}/{film}/词云.sha256"
+    if not os.path.isfile(cloud_path(film)) or not os.path.isfile(path):
+        return True
+    with open(path, mode='r', encoding="utf-8") as file:
+        return file.read().strip() != cloud_digest(film)
+
+
+# 生成词云并原子写入, 页面不会读到写了一半的图片
+def render_cloud(film: str, frequencies: dict) -> str:
+    path = cloud_path(film)
+    digest = cloud_digest(film)
+    image = word_clouds(frequencies=frequencies)
+    replace_atomic(path, lambda temp: image.save(temp, format="PNG"))
+    # 记录生成时的输入哈希, 批量预生成时据此跳过
+    write_atomic(f"{cachepath}/{film}/词云.sha256", digest.encode("utf-8"))
+    return path
+
+
+# 词云后台渲染: 每部电影同时只有一个渲染任务
+class CloudRenderer:
+    def __init__(self, workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cloud")
+        # 可重入: invalidate持锁时_drop和已完成任务的回调会再次加锁
+        self._lock = threading.RLock()
+        self._futures = {}
+
+    def submit(self, film: str, frequencies: dict):
+        with self._lock:
+            future = self._futures.get(film)
+            if future is None or future.done():
+                future = self._executor.submit(render_cloud, film, frequencies)
+                self._futures[film] = future
+            return future
+
+    # ready-已生成, pending-生成中, failed-生成失败, missing-未生成
+    def status(self, film: str) -> str:
+        future = self._futures.get(film)
+        if future is not None and not future.done():
+            return "pending"
+        if not cloud_stale(film):
+            return "ready"
+        if future is not None and future.exception() is not None:
+            return "failed"
+        return "missing"
+
+    def error(self, film: str):
+        future = self._futures.get(film)
+        return future.exception() if future is not None and future.done() else None
+
+    # 只删除这部电影的词云, 其他电影不受影响, 失败的结果也一起清除以便重新生成
+    # 正在生成时等生成完再删除, 返回False
+    def invalidate(self, film: str) -> bool:
+        with self._lock:
+            future = self._futures.get(film)
+            if future is not None and not future.done():
+                future.add_done_callback(lambda _: self._drop(film, future))
+                return False
+            self._drop(film)
+            return True
+
+    def _drop(self, film: str, future=None):
+        with self._lock:
+            # 回调触发前可能已经提交了新的渲染
+            if future is not None and self._futures.get(film) is not future:
+                return
+            self._futures.pop(film, None)
+            if os.path.isfile(cloud_path(film)):
+                os.remove(cloud_path(film))
+
+
+cloud_renderer = CloudRenderer()
+
+
+# 词云生成完成前显示占位, 每秒检查一次, 完成或失败后刷新页面停止检查
+@st.experimental_fragment(run_every=1)
+def cloud_placeholder(film: str, frequencies: dict):
+    status = cloud_renderer.status(film)
+    if status in ["ready", "failed"]:
+        st.rerun()
+    # 排队的重新生成在上一次完成后删除了图片, 再提交一次
+    if status == "missing":
+        cloud_renderer.submit(film=film, frequencies=frequencies)
+    st.info("词云图生成中...", icon="⏳")
+
+
+# 图片字节按文件修改时间缓存, 计入内存预算
+@flight_cached()
+def load_image(path: str, mtime: float) -> bytes:
+    with open(path, mode='rb') as file:
+        return file.read()
+
+
+def read_image(path: str) -> bytes:
+    return load_image(path=path, mtime=os.path.getmtime(path))
+
+
+# 页面显示词云: 已生成直接读取, 否则提交后台渲染
+def cloud_image(film: str, frequencies: dict):
+    if not cloud_stale(film):
+        st.image(read_image(cloud_path(film)))
+        return
+    # 失败后不再自动重试和轮询, 点击重新生成才会清除
+    if cloud_renderer.status(film) == "failed":
+        st.error(f"词云图生成失败: {cloud_renderer.error(film)}")
+        return
+    cloud_renderer.submit(film=film, frequencies=frequencies)
+    cloud_placeholder(film=film, frequencies=frequencies)
+
+
 # 自定义的page菜单
 def diy_menu(_page: str, _page_dict: dict) -> None:
     pages = list(_page_dict.keys())
@@ -345,17 +1469,85 @@ def diy_menu(_page: str, _page_dict: dict) -> None:
         st.switch_page(_page_dict[page])
 
 
+# 完整的键值清单, 没有或版本不同才重新下载
+def keys_manifest(_db: int) -> dict:
+    manifest = None
+    if os.path.isfile(manifest_path):
+        # 文件修改时间参与缓存, 重新下载后自动重新读取
+        manifest = read_manifest(path=manifest_path, mtime=os.path.getmtime(manifest_path))
+    if manifest is None or manifest.get("version") != MANIFEST_VERSION:
+        with st.spinner("下载键值中..."):
+            keys_cache(db=_db)
+        manifest = read_manifest(path=manifest_path, mtime=os.path.getmtime(manifest_path))
+    return manifest
+
+
+# {电影: {用户: [id...], 短评: [id...], 长评: [id...]}}
 def get_keysCache(_db: int):
-    # 只读取键值缓存
-    if os.path.isfile(f"{cachepath}/键值.txt"):
-        # 文件信息需要拆分
-        keysString = read_txt(f"{cachepath}/键值.txt")
-        keysCache = {}
-        # 列表的字典 {x: [a,b,c...], y: [d,e,f...]...}
-        for index, keyString in zip(["详情", "用户", "短评", "长评"], keysString):
-            keysList = keyString.split('|')
-            keysCache[index] = keysList
-    else:
-        # 列表的字典 {x: [a,b,c...], y: [d,e,f...]...}
-        keysCache = keys_cache(db=_db)
-    return keysCache
+    return keys_manifest(_db=_db)["films"]
+
+
+# 电影元数据目录: 详情字段+封面信息, 按电影名索引, 过期后重新拉取
+class FilmCatalog:
+    cover_fields = ["summary", "avatars", "names", "cover"]
+
+    def __init__(self, db: int, ttl: float = 600):
+        self.db = db
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._frame = None
+        self._infos = []
+        self._loaded = 0.0
+        # 加载时键值清单的第几次生成, 同步或重新下载键值后清单变化就重新加载
+        self._generation = None
+
+    def load(self):
+        manifest = keys_manifest(_db=self.db)
+        films = list(manifest["films"])
+        r = init_connection(db=self.db)
+        infos = fetch_hashes(_r=r, keys=[film_key(film, "详情") for film in films])
+        covers = fetch_hashes(_r=r, keys=[film_key(film, "封面") for film in films], fields=self.cover_fields)
+        # 详情里已有的字段以详情为准
+        frame = pd.concat([infos, covers[covers.columns.difference(infos.columns, sort=False)]], axis=1)
+        frame.index = pd.Index(films, name="电影")
+        self._infos = list(infos.columns)
+        self._frame = frame
+        self._loaded = time.time()
+        self._generation = manifest["generation"]
+
+    def expired(self) -> bool:
+        return self._frame is None or time.time() - self._loaded > self.ttl \
+            or keys_manifest(_db=self.db)["generation"] != self._generation
+
+    def frame(self) -> pd.DataFrame:
+        if self.expired():
+            with self._lock:
+                if self.expired():
+                    self.load()
+        return self._frame
+
+    @property
+    def films(self) -> list:
+        return self.frame().index.to_list()
+
+    # 单部电影的全部元数据
+    def get(self, film: str) -> pd.Series:
+        return self.frame().loc[film]
+
+    def rows(self, films: list) -> pd.DataFrame:
+        return self.frame().loc[films]
+
+    # 单部电影的详情, 和缓存的详情表格式一致: 类别/信息
+    def details(self, film: str) -> pd.DataFrame:
+        return self.frame().loc[film, self._infos].rename_axis("类别").rename("信息").reset_index()
+
+    # 所有电影的详情字段, 和逐个读取详情的表格一致
+    def infos(self) -> pd.DataFrame:
+        frame = self.frame()
+        return frame[self._infos].reset_index(drop=True)
+
+
+# 每个进程每个数据库只有一个目录
+@st.cache_resource
+def film_catalog(db: int) -> FilmCatalog:
+    return FilmCatalog(db=db)
@@ -1,9 +1,8 @@
-import collections
+import math
 import os
 import random
 
 import pandas as pd
-import redis
 # import requests
 import streamlit as st
 import streamlit_shadcn_ui as ui
@@ -11,9 +10,10 @@ import streamlit_shadcn_ui as ui
 from streamlit_image_select import image_select
 from streamlit_star_rating import st_star_rating
 
-from data.modules import diy_menu, pages_dict, cachepath, read_txt, read_excel, \
-    pie_chart_module, point_chart_module, datapath, word_filter, word_clouds, initialize, init_connection, get_value, \
-    get_values, all_cache, checkcache, film_cache, get_keysCache
+from data.modules import diy_menu, pages_dict, \
+    pie_chart_module, point_chart_module, datapath, read_tokens, cloud_image, cloud_renderer, initialize, init_connection, get_value, \
+    film_catalog, all_cache, all_sync, checkcache, film_cache, get_keysCache, film_key, read_aggregates, \
+    covers_cache, prefetch_covers, cover_path, thumb_path, read_image, read_sentiment, bar_chart_module
 
 # 初始化
 initialize()
@@ -39,29 +39,18 @@ diy_menu(_page="主页", _page_dict=pages_dict)
 keysCache = get_keysCache(_db=DB)
 
 # 获取电影列表
-films = [filmkey.split(" : ")[1] for filmkey in keysCache["详情"]]
+films = list(keysCache)
 selected_films = st.multiselect(label="搜索电影", options=films, default=None)
 if not selected_films:
     selected_films = films
 
 
-# 获取封面相关信息
-def get_cover_infos(_db: int):
-    try:
-        with init_connection(db=_db) as _r:
-            result = get_values(_r=_r, keys=[f"电影 : {_} : 封面" for _ in selected_films])
-    except Exception as e:
-        st.error(f"{e}\n数据库连接失败")
-    return result
-
-
-all_data = get_cover_infos(_db=DB)
-# image_urls = all_data["cover"]
-# image_urls = ["https://img3.doubanio.com/view/photo/s_ratio_poster/public/p480747492.webp",
-#               "https://img1.doubanio.com/view/photo/s_ratio_poster/public/p2561716440.webp",
-#               "https://img3.doubanio.com/view/photo/s_ratio_poster/public/p2372307693.webp"]
-avatar_urls = all_data["avatars"]
-avatar_names = all_data["names"]
+# 电影元数据目录-每个进程加载一次
+try:
+    catalog = film_catalog(db=DB)
+    catalog.frame()
+except Exception as e:
+    st.error(f"{e}\n数据库连接失败")
 
 # 侧边栏+所有缓存任务
 with st.sidebar:
@@ -70,6 +59,7 @@ with st.sidebar:
     with st.container(border=True):
         st.markdown("#### 缓存操作: ####")
         MODE = st.toggle("强制覆盖", help="强制覆盖耗时更久", value=False)
+        WORKERS = st.number_input("并发数", help="同时拉取和写入缓存的线程数", value=4, min_value=1, max_value=32)
         # 重新启用缓存
         if st.button("全部缓存",
                      type="primary",
@@ -80,32 +70,17 @@ with st.sidebar:
         #              use_container_width=True,
         #              disabled=True):
         #     # 全部缓存
-            all_cache(_db=DB, _mode=MODE)
-
-
-# 连接数据库获取图片内容
-def get_covers(_films: list[str], mode: bool):
-    # 图片二进制不需要解码film
-    with redis.Redis(connection_pool=redis.ConnectionPool(
-            host='175.178.4.58', port=6379, password="momuhoka", db=DB)) as r:
-        pipe = r.pipeline()
-    image_films = []
-    for _film in _films:
-        if not os.path.exists(f"{cachepath}/{_film}"):
-            # 判断目录是否存在，不存在则创建
-            os.mkdir(f"{cachepath}/{_film}")
-        if not os.path.exists(f"{cachepath}/{_film}/images"):
-            os.mkdir(f"{cachepath}/{_film}/images")
-        # mode=True 强制覆盖刷新封面缓存
-        if not os.path.exists(f"{cachepath}/{_film}/images/cover.jpg") or mode:
-            pipe.get(f"电影 : {_film} : 图片")
-            image_films.append(_film)
-    # 添加标志以免无效运行
-    if image_films:
-        images = pipe.execute()
-        for image, image_film in zip(images, image_films):
-            with open(f"{cachepath}/{image_film}/images/cover.jpg", 'wb') as f:
-                f.write(image)
+            all_cache(_db=DB, _mode=MODE, _workers=WORKERS)
+        # 只拉取本地缺少的数据
+        if st.button("增量同步",
+                     help="只拉取数据库中新增的用户和评论",
+                     use_container_width=True):
+            synced = all_sync(_db=DB, _workers=WORKERS)
+            st.success(f"已同步{len(synced)}部电影")
+    # 封面分页
+    with st.container(border=True):
+        st.markdown("#### 封面浏览: ####")
+        PAGE_SIZE = st.select_slider("每页电影数", options=[12, 24, 48, 96], value=24)
 
 
 # # 发起GET请求获取图片内容
@@ -121,83 +96,68 @@ def get_covers(_films: list[str], mode: bool):
 #             f.write(response.content)
 
 
+# 分页: 首页只加载当前页的封面和信息
+pages = max(1, math.ceil(len(selected_films) / PAGE_SIZE))
+page = st.number_input(f"页码(共{pages}页)", min_value=1, max_value=pages, value=1) if pages > 1 else 1
+page_films = selected_films[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+
+# 当前页的封面信息, 从内存目录读取
+all_data = catalog.rows(page_films).reset_index(drop=True)
+# image_urls = all_data["cover"]
+# image_urls = ["https://img3.doubanio.com/view/photo/s_ratio_poster/public/p480747492.webp",
+#               "https://img1.doubanio.com/view/photo/s_ratio_poster/public/p2561716440.webp",
+#               "https://img3.doubanio.com/view/photo/s_ratio_poster/public/p2372307693.webp"]
+avatar_urls = all_data["avatars"]
+avatar_names = all_data["names"]
+
 col_1, col_2 = st.columns(spec=[0.25, 0.75])
 
-# 获取所有图片
+# 获取当前页图片-首页只用缩略图
 try:
-    get_covers(_films=selected_films, mode=False)
+    covers_cache(db=DB, films=page_films, mode=False, workers=WORKERS)
+    # 后台预取下一页
+    prefetch_covers(db=DB, films=selected_films[page * PAGE_SIZE:(page + 1) * PAGE_SIZE], workers=WORKERS)
 except Exception as e:
     st.write(e)
-cover_paths = [f"{os.getcwd()}/cache/{_}/images/cover.jpg" for _ in selected_films]
+cover_paths = [os.path.abspath(thumb_path(_)) for _ in page_films]
 
 # 选择电影
 film_index = image_select(
     label="选择电影",
     images=cover_paths,
     use_container_width=False,
-    captions=selected_films,
+    captions=page_films,
     return_value="index",
 )
-film = selected_films[film_index]
+film = page_films[film_index]
 
 # 缓存信息
 with st.sidebar:
     # 手动展开
     check = st.checkbox("查看缓存状态", value=False)
-    cache_status = checkcache(film=film)
-    # 展示缓存
+    # 展示缓存-展开时才比较本地和数据库的id
     if check:
-        # 显示缓存状态
+        cache_status = checkcache(db=DB, film=film, keysCache=keysCache)
+        # 显示缓存状态 fresh-最新 stale-缺少部分数据或数据库有更新 missing-没有缓存
         status = pd.DataFrame(cache_status).T \
             .rename_axis(index=film) \
-            .rename(columns={0: "是否缓存", 1: "缓存时间"})
+            .rename(columns={0: "缓存状态", 1: "缓存时间", 2: "本地条数", 3: "清单条数"})
         st.dataframe(status, use_container_width=True)
 
 # 得到电影后就可以开始缓存-放在all_cache之后
 film_cache(_db=DB, film=film, keysCache=keysCache, mode=MODE)
 if MODE:
-    # mode=True 时以防万一覆盖图片
-    get_covers(_films=[film], mode=True)
-
-# 图表的基础数据源
-usersDf = read_excel(f"{cachepath}/{film}/用户.xlsx")
-scommsDf = read_excel(f"{cachepath}/{film}/短评.xlsx")
-fcommsDf = read_excel(f"{cachepath}/{film}/长评.xlsx")
-# 评论拼接
-fcommsDf.rename(columns={"full_comment": "comment"}, inplace=True)  # 拼接列名一致
-sandfDf = pd.concat([scommsDf, fcommsDf], axis=0).astype(str)
-comString = '|'.join(sandfDf["comment"].to_list())
-# 用户ip处理
-# 用于判断属地 - 常居地 > IP
-LOCATIONS = ["河北", "山西", "辽宁", "吉林", "黑龙江", "江苏",
-             "浙江", "安徽", "福建", "江西", "山东", "河南",
-             "湖北", "湖南", "广东", "海南", "四川", "贵州",
-             "云南", "陕西", "甘肃", "青海", "台湾", "内蒙古",
-             "广西", "西藏", "宁夏", "新疆", "北京", "天津",
-             "上海", "重庆", "香港", "澳门"]
-# IP异常用location填充
-usersDf.fillna({"ip": usersDf["location"]}, inplace=True)
-# ip置换
-for ip in usersDf["ip"].astype(str):
-    for pos in LOCATIONS:
-        if pos in ip:
-            usersDf["ip"].replace(ip, pos, inplace=True)
-            break
-# 过滤 nan
-usersDf.dropna(axis=0, how="any", subset=["ip"], inplace=True)
+    # mode=True 时以防万一覆盖图片, 内容没变不会重写
+    covers_cache(db=DB, films=[film], mode=True)
 
 with col_1:
     with st.container(border=True):
-        st.image(cover_paths[film_index], use_column_width=True)
+        st.image(read_image(cover_path(film)), use_column_width=True)
 with col_2:
-    try:
-        with init_connection(db=DB) as r:
-            value = get_value(_r=r, key=f"电影 : {film} : 详情")
-    except Exception as e:
-        st.error(f"{e}\n数据库连接失败")
+    value = catalog.get(film)
     col_2_1, col_2_2 = st.columns(spec=[0.7, 0.3])
     with col_2_1:
-        st.markdown(f"#### 🎞️{selected_films[film_index]}")
+        st.markdown(f"#### 🎞️{film}")
         st.markdown(f"**🗳投票数: {value['votes']}**  **🍿类型: {value['filmtype']}**"
                     f"  **📀年份: {value['year']}**  **⌛时长: {value['times']}min**"
                     f"  **📜语言: {value['language']}**")
@@ -210,9 +170,9 @@ with col_2:
             if st.button("重新生成词云图",
                          type="primary",
                          use_container_width=True):
-                os.remove(f"{cachepath}/{film}/词云.png")
-                # 清除st.cahce_data的图片缓存
-                word_clouds.clear()
+                # 只清除这部电影的词云, 正在生成时等生成完再清除
+                if not cloud_renderer.invalidate(film):
+                    st.toast("词云图正在生成, 完成后会重新生成", icon="⏳")
     if tab == "简介":
         st.markdown("**🎬演职员:**")
         colist = st.columns(spec=12)
@@ -230,63 +190,50 @@ with col_2:
     if tab == "评论":
         colist = st.columns(spec=3)
         if comm_sel == "短评":
-            comm_list = random.sample([_ for _ in keysCache["短评"] if f"电影 : {film} : 短评" in _], 3)
+            comm_list = random.sample(keysCache[film]["短评"], 3)
         else:
-            comm_list = random.sample([_ for _ in keysCache["长评"] if f"电影 : {film} : 长评" in _], 3)
+            comm_list = random.sample(keysCache[film]["长评"], 3)
+        # 只取卡片用到的字段
+        comm_field = "comment" if comm_sel == "短评" else "full_comment"
         for comm, co in zip(comm_list, colist):
             with co:
                 try:
-                    with init_connection(db=DB) as r:
-                        value = get_value(_r=r, key=comm)
-                    comment = value["comment"]
-                except KeyError:
-                    comment = value["full_comment"]
+                    r = init_connection(db=DB)
+                    value = get_value(_r=r, key=film_key(film, comm_sel, comm),
+                                      fields=[comm_field, "date", "star"])
+                    comment = value[comm_field]
                 except Exception as e:
                     st.error(f"{e}\n数据库连接失败")
                 with st.container(border=True, height=270):
-                    ui.metric_card(title=f"用户: {comm.split(' : ')[3]}", content=comment,
+                    ui.metric_card(title=f"用户: {comm}", content=comment,
                                    description=f"{value['date']}留言-⭐{value['star']}", key=str(co))
     if tab == "分析":
-        tab_1, tab_2, tab_3 = st.tabs(["用户分布饼状图", "用户信息散点图", "影评推荐指数"])
+        # 缓存时已经汇总好的图表数据
+        aggregates = read_aggregates(film)
+        tab_1, tab_2, tab_3, tab_4 = st.tabs(["用户分布饼状图", "用户信息散点图", "影评推荐指数", "情感预测"])
         with tab_1:
-            # 取出对应电影数据 astype-float型转换成str
-            ipList = usersDf["ip"].astype(str).to_list()
-            # 词频统计
-            ip_counts = dict(collections.Counter(ipList))  # 对IP做词频统计
             ipdata = pd.DataFrame({
-                "地域": list(ip_counts.keys()),
-                "数目": list(ip_counts.values())
+                "地域": list(aggregates["地域"].keys()),
+                "数目": list(aggregates["地域"].values())
             })
             with st.expander(f"<{film}>-饼图", expanded=True):
                 fig1 = pie_chart_module(ipdata, "用户评论分布")
                 st.plotly_chart(fig1, use_container_width=True)
         with tab_2:
-            idList = usersDf["id"].astype(str)
-            yearList = usersDf["jointime"].to_list()
-            hadseenList = usersDf["hadseen"].fillna(0).to_list()
-            usersdata = pd.DataFrame({
-                "ID": idList,
-                "IP": ipList,
-                "加入年份": yearList,
-                "豆瓣网龄": [2024 - int(x[0:4]) for x in yearList],
-                "看过电影": hadseenList
-            })
+            usersdata = pd.DataFrame(aggregates["散点"])
+            usersdata.insert(3, "豆瓣网龄", [2024 - int(x[0:4]) for x in usersdata["加入年份"]])
             with st.expander(f"<{film}>-散点图", expanded=True):
                 fig2 = point_chart_module(usersdata)
                 st.plotly_chart(fig2, use_container_width=True)
         with tab_3:
             co3, co4 = st.columns(spec=2)
             with co3:
-                starList = scommsDf["star"].astype(str).replace("-1.0", "1.0").tolist()
-                star_map = {"1.0": "很差", "2.0": "较差", "3.0": "还行", "4.0": "推荐", "5.0": "力荐"}
-                starList_mapped = [star_map[star] for star in starList]
-                star_counts = dict(collections.Counter(starList_mapped))
                 star_data = pd.DataFrame({
-                    "星级": list(star_counts.keys()),
-                    "数目": list(star_counts.values())
+                    "星级": list(aggregates["星级"].keys()),
+                    "数目": list(aggregates["星级"].values())
                 })
                 with st.expander(f"<{film}>-饼图", expanded=True):
-                    fig_star = pie_chart_module(star_data, "用户评分分布")
+                    fig_star = pie_chart_module(star_data, f"用户评分分布({aggregates['评论数']['短评']}条短评)")
                     st.plotly_chart(fig_star, use_container_width=True)
             with co4:
                 reviews = ['短评', '长评']
@@ -295,40 +242,37 @@ with col_2:
                         '精选评论',
                         reviews
                     )
-                    if option == '短评':
-                        index1 = scommsDf[scommsDf['star'] == 5.0].index[0]
-                        comment = scommsDf.loc[index1, 'comment']
-                        user_data = scommsDf.loc[index1, '用户']
-                        date_data = scommsDf.loc[index1, 'date']
-                        homepage = scommsDf.loc[index1, 'homepage']
-                        with st.container(height=250, border=True):
-                            st.markdown(f"> **{comment}**")
-                            st.markdown(f"用户: {user_data}")
-                            st.markdown(f"日期: {date_data}")
-                        st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
-                        st.markdown(f"*{homepage}*")
+                    featured = aggregates["精选"][option]
+                    if featured is None:
+                        st.info("没有符合条件的精选评论")
                     else:
-                        index1 = fcommsDf[(fcommsDf['star'] == 5.0) & (fcommsDf['comment'].str.len() < 200)].index[0]
-                        comment = fcommsDf.loc[index1, 'comment']
-                        user_data = fcommsDf.loc[index1, '用户']
-                        date_data = fcommsDf.loc[index1, 'date']
-                        homepage = fcommsDf.loc[index1, 'homepage']
                         with st.container(height=250, border=True):
-                            st.markdown(f"> **{comment}**")
-                            st.markdown(f"用户: {user_data}")
-                            st.markdown(f"日期: {date_data}")
-                        st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
-                        st.markdown(f"*{homepage}*")
+                            st.markdown(f"> **{featured['comment']}**")
+                            st.markdown(f"用户: {featured['用户']}")
+                            st.markdown(f"日期: {featured['date']}")
+                        # 没有主页链接就不显示
+                        if featured['homepage']:
+                            st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
+                            st.markdown(f"*{featured['homepage']}*")
+        with tab_4:
+            # 离线批量预测的结果, 页面不调用模型
+            sentiment = read_sentiment(film)
+            if sentiment is None:
+                st.info("还没有情感预测结果, 请先运行 `python -m data.jobs score --model 模型名`", icon="ℹ️")
+            else:
+                sentiment, sentiment_model = sentiment
+                with st.expander(f"<{film}>-模型预测/星级情感 (模型: {sentiment_model})", expanded=True):
+                    fig_sentiment = bar_chart_module(sentiment, f"情感分布({sentiment['模型预测'].sum()}条评论)")
+                    st.plotly_chart(fig_sentiment, use_container_width=True)
+                    st.dataframe(sentiment, use_container_width=True)
     if tab == "词云":
         if not os.path.isfile(f"{datapath}/new_stopwords.txt"):
             st.markdown(f"# 在{datapath}没有找到new_stopwords.txt文件")
         else:
             co1, co2 = st.columns(spec=[0.6, 0.4])
-            stopwords = read_txt(f"{datapath}/new_stopwords.txt")
-            words = word_filter(comstring=comString, name=film, stopwords=stopwords)
-            # 词频统计
-            word_counts = collections.Counter(words)  # 对分词做词频统计
-            word_counts_top = word_counts.most_common(20)  # 获取最高频的词
+            # 缓存好的词频, 已按频次排序
+            frequencies = read_tokens(film)
+            word_counts_top = list(frequencies.items())[:20]  # 获取最高频的词
             with co2:
                 # 高频词展示
                 wordTop = pd.DataFrame(word_counts_top).rename(
@@ -337,13 +281,5 @@ with col_2:
                 st.info("词云图背景以第一个高频中文词决定", icon="ℹ️")
             with co1:
                 with st.expander(f"<{film}>-词云图", expanded=True):
-                    if not os.path.isfile(f"{cachepath}/{film}/词云.png"):
-                        # 调用函数+缓存
-                        fig = word_clouds(words=words, hotwords=word_counts_top)
-                        st.image(fig)
-                        if not os.path.exists(f"{cachepath}/{film}"):
-                            os.mkdir(f"{cachepath}/{film}")
-                        fig.save(f"{cachepath}/{film}/词云.png")
-                    else:  # 存在词云文件
-                        # 读取词云图
-                        st.image(f"{cachepath}/{film}/词云.png")
+                    # 已生成直接读取, 否则后台生成并显示占位
+                    cloud_image(film=film, frequencies=frequencies)
@@ -1,12 +1,12 @@
-import collections
 import os.path
 import streamlit as st
 import pandas as pd
 
-from data.modules import (initialize, cachepath, read_txt, read_excel,
+from data.modules import (initialize, read_cache, export_excel,
                           pie_chart_module, point_chart_module,
-                          datapath, word_filter, word_clouds,
-                          diy_menu, pages_dict, get_keysCache, film_cache)
+                          datapath, read_tokens, cloud_image, cloud_renderer,
+                          diy_menu, pages_dict, get_keysCache, film_cache, read_aggregates,
+                          film_catalog)
 # 初始化
 initialize()
 
@@ -38,7 +38,7 @@ st.info('电影详情一览')
 keysCache = get_keysCache(_db=DB)
 
 # 获取电影列表
-films = [filmkey.split(" : ")[1] for filmkey in keysCache["详情"]]
+films = list(keysCache)
 
 film = st.selectbox(
     "电影列表", films, help="输入以搜索"
@@ -52,8 +52,7 @@ film_cache(_db=DB, film=film, keysCache=keysCache, mode=False)
 choice = st.selectbox(
     "选择", ["详情", "用户", "短评", "长评"]
 )
-chosen_str = f"电影 : {film} : {choice}"
-chosen_keys = [key for key in keysCache[choice] if chosen_str in key]
+chosen_keys = keysCache[film].get(choice, [])
 desc = {
     "详情": f"{choice}-<{film}>",
     "用户": f"已收集{choice}信息: {len(chosen_keys)}",
@@ -62,65 +61,32 @@ desc = {
 }
 
 # 显示选择的电影信息
-# 这里一定要有缓存
-values = read_excel(f"{cachepath}/{film}/{choice}.xlsx")
+# 详情从内存中的电影目录读取, 其余一定要有缓存
+values = film_catalog(db=DB).details(film) if choice == "详情" else read_cache(film, choice)
 expander = st.expander(desc[choice])
 expander.dataframe(values, use_container_width=True, hide_index=True)
+# xlsx只在需要时导出
+if expander.button("导出xlsx"):
+    expander.download_button("下载xlsx", data=export_excel(film, choice), file_name=f"{film}-{choice}.xlsx")
 
-# 图表的基础数据源
-usersDf = read_excel(f"{cachepath}/{film}/用户.xlsx")
-scommsDf = read_excel(f"{cachepath}/{film}/短评.xlsx")
-fcommsDf = read_excel(f"{cachepath}/{film}/长评.xlsx")
-# 评论拼接
-fcommsDf.rename(columns={"full_comment": "comment"}, inplace=True)  # 拼接列名一致
-sandfDf = pd.concat([scommsDf, fcommsDf], axis=0).astype(str)
-comString = '|'.join(sandfDf["comment"].to_list())
-# 用户ip处理
-# 用于判断属地 - 常居地 > IP
-LOCATIONS = ["河北", "山西", "辽宁", "吉林", "黑龙江", "江苏",
-             "浙江", "安徽", "福建", "江西", "山东", "河南",
-             "湖北", "湖南", "广东", "海南", "四川", "贵州",
-             "云南", "陕西", "甘肃", "青海", "台湾", "内蒙古",
-             "广西", "西藏", "宁夏", "新疆", "北京", "天津",
-             "上海", "重庆", "香港", "澳门"]
-# IP异常用location填充
-usersDf["ip"].fillna(usersDf["location"], inplace=True)
-# ip置换
-for ip in usersDf["ip"].astype(str):
-    for pos in LOCATIONS:
-        if pos in ip:
-            usersDf["ip"].replace(ip, pos, inplace=True)
-            break
-# 过滤 nan
-usersDf.dropna(axis=0, how="any", subset=["ip"], inplace=True)
+# 缓存时已经汇总好的图表数据
+aggregates = read_aggregates(film)
 
 tab_1, tab_2 ,tab_3= st.tabs(["电影评论", "电影云图", "影评推荐指数"])
 # 图表部分
 with tab_1:
     col_1, col_2 = st.columns(spec=2)
     with col_1:
-        # 取出对应电影数据 astype-float型转换成str
-        ipList = usersDf["ip"].astype(str).to_list()
-        # 词频统计
-        ip_counts = dict(collections.Counter(ipList))  # 对IP做词频统计
         ipdata = pd.DataFrame({
-            "地域": list(ip_counts.keys()),
-            "数目": list(ip_counts.values())
+            "地域": list(aggregates["地域"].keys()),
+            "数目": list(aggregates["地域"].values())
         })
         with st.expander(f"<{film}>-饼图", expanded=True):
             fig1 = pie_chart_module(ipdata,"用户评论分布")
             st.plotly_chart(fig1, use_container_width=True)
     with col_2:
-        idList = usersDf["id"].astype(str)
-        yearList = usersDf["jointime"].to_list()
-        hadseenList = usersDf["hadseen"].fillna(0).to_list()
-        usersdata = pd.DataFrame({
-            "ID": idList,
-            "IP": ipList,
-            "加入年份": yearList,
-            "豆瓣网龄": [2024-int(x[0:4]) for x in yearList],
-            "看过电影": hadseenList
-        })
+        usersdata = pd.DataFrame(aggregates["散点"])
+        usersdata.insert(3, "豆瓣网龄", [2024-int(x[0:4]) for x in usersdata["加入年份"]])
         with st.expander(f"<{film}>-散点图", expanded=True):
             fig2 = point_chart_module(usersdata)
             st.plotly_chart(fig2, use_container_width=True)
@@ -130,18 +96,16 @@ with tab_2:
         st.markdown(f"# 在{datapath}没有找到new_stopwords.txt文件")
     else:
         co1, co2 = st.columns(spec=[0.6, 0.4])
-        stopwords = read_txt(f"{datapath}/new_stopwords.txt")
-        words = word_filter(comstring=comString, name=film, stopwords=stopwords)
-        # 词频统计
-        word_counts = collections.Counter(words)  # 对分词做词频统计
-        word_counts_top = word_counts.most_common(20)  # 获取最高频的词
+        # 缓存好的词频, 已按频次排序
+        frequencies = read_tokens(film)
+        word_counts_top = list(frequencies.items())[:20]  # 获取最高频的词
         with co2:
             if st.button("重新生成词云图",
                          type="primary",
                          use_container_width=True):
-                os.remove(f"{cachepath}/{film}/词云.png")
-                # 清除st.cahce_data的图片缓存
-                word_clouds.clear()
+                # 只清除这部电影的词云, 正在生成时等生成完再清除
+                if not cloud_renderer.invalidate(film):
+                    st.toast("词云图正在生成, 完成后会重新生成", icon="⏳")
             # 高频词展示
             wordTop = pd.DataFrame(word_counts_top).rename(
                 columns={0: "分词", 1: "频次"})
@@ -149,29 +113,17 @@ with tab_2:
             st.info("词云图背景以第一个高频中文词决定", icon="ℹ️")
         with co1:
             with st.expander(f"<{film}>-词云图", expanded=True):
-                if not os.path.isfile(f"{cachepath}/{film}/词云.png"):
-                    # 调用函数+缓存
-                    fig = word_clouds(words=words, hotwords=word_counts_top)
-                    st.image(fig)
-                    if not os.path.exists(f"{cachepath}/{film}"):
-                        os.mkdir(f"{cachepath}/{film}")
-                    fig.save(f"{cachepath}/{film}/词云.png")
-                else:  # 存在词云文件
-                    # 读取词云图
-                    st.image(f"{cachepath}/{film}/词云.png")
+                # 已生成直接读取, 否则后台生成并显示占位
+                cloud_image(film=film, frequencies=frequencies)
 with tab_3:
     co3, co4 = st.columns(spec=2)
     with co3:
-        starList = scommsDf["star"].astype(str).replace("-1.0", "1.0").tolist()
-        star_map = {"1.0": "很差", "2.0": "较差", "3.0": "还行", "4.0": "推荐", "5.0": "力荐"}
-        starList_mapped = [star_map[star] for star in starList]
-        star_counts = dict(collections.Counter(starList_mapped))
         star_data = pd.DataFrame({
-            "星级": list(star_counts.keys()),
-            "数目": list(star_counts.values())
+            "星级": list(aggregates["星级"].keys()),
+            "数目": list(aggregates["星级"].values())
         })
         with st.expander(f"<{film}>-饼图", expanded=True):
-            fig_star = pie_chart_module(star_data, "用户评分分布")
+            fig_star = pie_chart_module(star_data, f"用户评分分布({aggregates['评论数']['短评']}条短评)")
             st.plotly_chart(fig_star, use_container_width=True)
     with co4:
         reviews = ['短评', '长评']
@@ -180,28 +132,15 @@ with tab_3:
                 '精选评论',
                 reviews
             )
-            if option == '短评':
-                index1 = scommsDf[scommsDf['star'] == 5.0].index[0]
-                comment = scommsDf.loc[index1, 'comment']
-                user_data = scommsDf.loc[index1, '用户']
-                date_data = scommsDf.loc[index1, 'date']
-                homepage = scommsDf.loc[index1, 'homepage']
-                with st.container(height=250, border=True):
-                    st.markdown(f"> **{comment}**")
-                    st.markdown(f"用户: {user_data}")
-                    st.markdown(f"日期: {date_data}")
-                st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
-                st.markdown(f"*{homepage}*")
+            featured = aggregates["精选"][option]
+            if featured is None:
+                st.info("没有符合条件的精选评论")
             else:
-                index1 = fcommsDf[(fcommsDf['star'] == 5.0) & (fcommsDf['comment'].str.len() < 200)].index[0]
-                comment = fcommsDf.loc[index1, 'comment']
-                user_data = fcommsDf.loc[index1, '用户']
-                date_data = fcommsDf.loc[index1, 'date']
-                homepage = fcommsDf.loc[index1, 'homepage']
                 with st.container(height=250, border=True):
-                    st.markdown(f"> **{comment}**")
-                    st.markdown(f"用户: {user_data}")
-                    st.markdown(f"日期: {date_data}")
-                st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
-                st.markdown(f"*{homepage}*")
-
+                    st.markdown(f"> **{featured['comment']}**")
+                    st.markdown(f"用户: {featured['用户']}")
+                    st.markdown(f"日期: {featured['date']}")
+                # 没有主页链接就不显示
+                if featured['homepage']:
+                    st.markdown("*如果你对此用户感兴趣，下面是他的主页链接:*")
+                    st.markdown(f"*{featured['homepage']}*")
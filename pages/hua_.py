@@ -1,5 +1,5 @@
 import streamlit as st
-from data.modules import (initialize, diy_menu, pages_dict, init_connection)
+from data.modules import (initialize, diy_menu, pages_dict, init_connection, KeysCatalog)
 from streamlit_agraph import agraph, Node, Edge, Config
 
 # 设置全局属性
@@ -38,9 +38,9 @@ def handle_results(_results: list[str], _colors: list[str], _label):
 
 def film_type_relation():
     # 采用管道访问
-    with init_connection(db=6) as r:
-        keys = r.keys()
-        pipe = r.pipeline()
+    r = init_connection(db=6)
+    keys = KeysCatalog(r=r, patterns={"关系": "*"}).scan_all()["关系"]
+    pipe = r.pipeline()
     for key in keys:
         pipe.get(key)
     results = pipe.execute()  # 获取值
@@ -61,9 +61,9 @@ def film_type_relation():
 
 def film_actor_relation():
     # 采用管道访问
-    with init_connection(db=5) as r:
-        keys = r.keys()
-        pipe = r.pipeline()
+    r = init_connection(db=5)
+    keys = KeysCatalog(r=r, patterns={"关系": "*"}).scan_all()["关系"]
+    pipe = r.pipeline()
     for key in keys:
         pipe.get(key)
     results = pipe.execute()
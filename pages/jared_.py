@@ -7,8 +7,8 @@ import pandas as pd
 import plotly.express as px
 from matplotlib import font_manager
 
-from data.modules import (cachepath, read_txt, keys_cache, initialize,
-                          diy_menu, pages_dict, init_connection, get_values)
+from data.modules import (initialize, diy_menu, pages_dict,
+                          film_catalog)
 
 # 设置全局属性
 st.set_page_config(
@@ -51,24 +51,8 @@ st.title('豆瓣TOP250电影')
 st.info('电影整体概况')
 # 默认渲染到主界面
 
-# 只读取键值缓存
-if os.path.isfile(f"{cachepath}/键值.txt"):
-    # 文件信息需要拆分
-    keysString = read_txt(f"{cachepath}/键值.txt")
-    keysCache = {}
-    # 列表的字典 {x: [a,b,c...], y: [d,e,f...]...}
-    for index, keyString in zip(["详情", "用户", "短评", "长评"], keysString):
-        keysList = keyString.split('|')
-        keysCache[index] = keysList
-else:
-    # 列表的字典 {x: [a,b,c...], y: [d,e,f...]...}
-    keysCache = keys_cache(db=DB)
-
-# 获取电影列表
-infos = [_ for _ in keysCache["详情"]]
-
-with init_connection(db=DB) as r:
-    infos_dicts = get_values(_r=r, keys=infos)
+# 所有电影的详情, 从内存中的电影目录读取
+infos_dicts = film_catalog(db=DB).infos()
 # show
 st.dataframe(infos_dicts)
 tab_1, tab_2, tab_3, tab_4 = st.tabs(["电影评论", "电影分类", "影评推荐指数", "筛选电影"])
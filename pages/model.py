@@ -4,10 +4,9 @@ import time
 import streamlit as st
 import numpy as np
 import pandas as pd
-import thulac
 from stqdm import stqdm
 
-from data.modules import diy_menu, pages_dict, datapath
+from data.modules import diy_menu, pages_dict, datapath, storage
 
 # 设置全局属性
 st.set_page_config(
@@ -16,9 +15,6 @@ st.set_page_config(
     layout='wide',
     initial_sidebar_state='collapsed'
 )
-st.spinner("载入jieba分词缓存...")
-import jieba
-
 st.spinner("载入tensorflow模型库...")
 import tensorflow as tf
 
@@ -59,12 +55,18 @@ tf.config.threading.set_inter_op_parallelism_threads(threadings)
 tf.config.threading.set_intra_op_parallelism_threads(threadings)
 # Tensorflow相关库导入
 from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Embedding, Conv1D, GlobalMaxPooling1D, Dense, Dropout
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau
 # 自定义回调函数
 from data.keras.streamlit_callback import StreamlitLambdaCallback
+# 多进程分词, 转换表和补全表的内存映射文件
+from data.keras.preprocess import tokenized_frame, save_array, save_sequences, load_sequences, load_padded, \
+    save_labels, load_labels, tokenizer_vocab_size
+# 流式训练输入
+from data.keras.dataset import train_datasets
+# 预测用的模型注册表
+from data.keras.registry import ModelRegistry, LABELS
 
 # 部分文件存储位置
 if not os.path.exists(f"{datapath}/keras/saves"):
@@ -84,10 +86,11 @@ def checkdatafile(path: str):
     walkers = os.listdir(path)
     filespath = [f"{path}/{walker}" for walker in walkers if not os.path.isfile(f"{path}/{walker}")]
     for _filepath in filespath:
-        if not os.path.isfile(f"{_filepath}/短评.xlsx"):
-            return f"{_filepath}/短评.xlsx", False
-        if not os.path.isfile(f"{_filepath}/长评.xlsx"):
-            return f"{_filepath}/长评.xlsx", False
+        _film = os.path.basename(_filepath)
+        if not storage.exists(_film, "短评"):
+            return storage.path(_film, "短评"), False
+        if not storage.exists(_film, "长评"):
+            return storage.path(_film, "长评"), False
     return filespath, True
 
 
@@ -95,8 +98,9 @@ def checkdatafile(path: str):
 def pre_data_check():
     _tokenized_data_check = os.path.isfile(f"{datapath}/keras/tokenized_data.csv")
     _tokenizer_check = os.path.isfile(f"{datapath}/keras/tokenizer.pkl")
-    _sequences_check = os.path.isfile(f"{datapath}/keras/sequences.pkl")
-    _padded_check = os.path.isfile(f"{datapath}/keras/padded.pkl")
+    _sequences_check = os.path.isfile(f"{datapath}/keras/sequences_offsets.npy") and \
+        os.path.isfile(f"{datapath}/keras/sequences_values.npy")
+    _padded_check = os.path.isfile(f"{datapath}/keras/padded.npy") and os.path.isfile(f"{datapath}/keras/labels.npy")
     return _tokenized_data_check, _tokenizer_check, _sequences_check, _padded_check
 
 
@@ -137,16 +141,27 @@ def read_tokenizer(path: str):
     return _tokenizer
 
 
-@st.cache_data(show_spinner="读取数据中...")
-def read_sequences(path: str):
-    _sequences = read_data(_type="pkl", path=path)
-    return _sequences
+# 转换表和补全表只读内存映射, cache_resource不会每次复制一份
+# 文件修改时间参与缓存, 重新生成后自动更新, 只保留最新一份映射释放被替换的旧文件
+@st.cache_resource(max_entries=1, show_spinner="读取数据中...")
+def read_sequences(path: str, mtime: float):
+    return load_sequences(path=path)
 
 
-@st.cache_data(show_spinner="读取数据中...")
-def read_padded(path: str):
-    _padded = read_data(_type="pkl", path=path)
-    return _padded
+@st.cache_resource(max_entries=1, show_spinner="读取数据中...")
+def read_padded(path: str, mtime: float):
+    return load_padded(path=path)
+
+
+@st.cache_resource(max_entries=1, show_spinner="读取数据中...")
+def read_labels(path: str, mtime: float):
+    return load_labels(path=path)
+
+
+# 每个进程一个注册表, 模型和映射表按修改时间只加载并预热一次
+@st.cache_resource
+def model_registry():
+    return ModelRegistry(path=f"{datapath}/keras/saves", fallback_tokenizer=f"{datapath}/keras/tokenizer.pkl")
 
 
 @st.cache_resource(show_spinner="读取模型中...")
@@ -248,6 +263,9 @@ if train_module:
                     :green[{(1 - validation_split) * 100}]% **/** 
                     :blue[{validation_split * 100}]%
                     ''')
+                cache_dataset = st.toggle("缓存数据集", value=False,
+                                          help='''第一轮读取后缓存到内存, 之后每轮不再读取补全表.
+                                          数据集比内存大时不要开启''')
             with t3:
                 if filter_words:
                     show_filter_words = pd.DataFrame(filter_words).rename(columns={0: "自定义过滤"})
@@ -289,20 +307,13 @@ if train_module:
                 if cut_button or retokenizer_button:
                     # 清除对应函数缓存
                     read_cache.clear()
-                    # 分词
+                    # 分词-评论分块交给threadings个进程, 每完成一块更新进度
                     s = time.time()
-                    tokenized_data = pd.DataFrame()
-                    stqdm(st_container=infoholder_button).pandas(desc="数据处理进度")
+                    progress_bar = stqdm(total=len(data), st_container=infoholder_button, desc="数据处理进度")
                     # 三分类
-                    tokenized_data['sentiment'] = data['star'].astype(np.int16).apply(
-                        lambda x: 0 if x in [1, 2] else (1 if x == 3 else 2))
-                    if not cut_toggle:
-                        tokenized_data["tokenized_comment"] = data["comment"].astype(np.str_).progress_apply(
-                            lambda x: ' '.join(jieba.cut(x)))
-                    else:
-                        thu = thulac.thulac(seg_only=True, filt=True)
-                        tokenized_data["tokenized_comment"] = data["comment"].astype(np.str_).progress_apply(
-                            lambda x: thu.cut(x, text=True))
+                    tokenized_data = tokenized_frame(data, engine="thulac" if cut_toggle else "jieba",
+                                                     workers=threadings, progress=progress_bar.update)
+                    progress_bar.close()
                     e = time.time()
                     infoholder.info("**成功生成数据表:** {:.2f}s".format(e - s))
                     tokenized_data.to_csv(f"{datapath}/keras/tokenized_data.csv")
@@ -357,17 +368,21 @@ if train_module:
                         seqholder_button.empty()
                         s = time.time()
                         with st.spinner("评论转换表生成中..."):
-                            sequences = tokenizer.texts_to_sequences(
-                                tokenized_data["tokenized_comment"].astype(np.str_))
+                            save_sequences(f"{datapath}/keras", tokenizer.texts_to_sequences(
+                                tokenized_data["tokenized_comment"].astype(np.str_)),
+                                vocab_size=tokenizer_vocab_size(tokenizer))
+                            sequences = read_sequences(
+                                path=f"{datapath}/keras",
+                                mtime=os.path.getmtime(f"{datapath}/keras/sequences_values.npy"))
                         e = time.time()
                         seqholder.info("**成功生成评论转换表:** {:.2f}s".format(e - s))
-                        with open(f"{datapath}/keras/sequences.pkl", "wb") as file:
-                            pickle.dump(sequences, file)
                         sequences_check = True
                     else:
                         if sequences_check:
-                            # 从文件中加载 sequences 对象
-                            sequences = read_sequences(path=f"{datapath}/keras/sequences.pkl")
+                            # 内存映射读取 sequences
+                            sequences = read_sequences(
+                                path=f"{datapath}/keras",
+                                mtime=os.path.getmtime(f"{datapath}/keras/sequences_values.npy"))
                             seqholder.info(f":green[**检测到评论转换表缓存**]: {len(sequences)}")
                         else:
                             sequences = None
@@ -380,20 +395,23 @@ if train_module:
                     if pad_button or retokenizer_button:
                         # 清除对应函数缓存
                         read_padded.clear()
+                        read_labels.clear()
                         padholder_button.empty()
                         s = time.time()
                         with st.spinner("转换补全表生成中..."):
-                            # pad_sequences, 对上面生成的不定长序列进行补全
-                            padded = pad_sequences(sequences, maxlen=max_length, padding="post", truncating="post")
+                            # 对上面生成的不定长序列进行补全, 同pad_sequences(padding="post", truncating="post")
+                            save_array(f"{datapath}/keras/padded.npy", sequences.pad(maxlen=max_length))
+                            save_labels(f"{datapath}/keras", tokenized_data["sentiment"])
+                            padded = read_padded(path=f"{datapath}/keras",
+                                                 mtime=os.path.getmtime(f"{datapath}/keras/padded.npy"))
                         e = time.time()
                         padholder.info("**成功生成转换补全表:** {:.2f}s".format(e - s))
-                        with open(f"{datapath}/keras/padded.pkl", "wb") as file:
-                            pickle.dump(padded, file)
                         padded_check = True
                     else:
                         if padded_check:
-                            # 从文件中加载 padded 对象
-                            padded = read_padded(path=f"{datapath}/keras/padded.pkl")
+                            # 内存映射读取 padded
+                            padded = read_padded(path=f"{datapath}/keras",
+                                                 mtime=os.path.getmtime(f"{datapath}/keras/padded.npy"))
                             padholder.info(f":green[**检测到转换补全表缓存**]: {len(padded)}")
                         else:
                             padded = None
@@ -438,18 +456,22 @@ if train_module:
                             show_seq = show_seq.rename(columns={0: "特征值"}).rename_axis("时间步")
                         st.dataframe(show_seq, use_container_width=True)
                     with t4:
-                        # 补全表展示
+                        # 补全表展示, 只取一页不把整个映射读进内存
                         show_padded = None
                         if padded is not None:
-                            show_padded = pd.DataFrame(padded).rename_axis("序列ID")
-                            show_padded.index = show_padded.index + 1
+                            pages = max(1, -(-len(padded) // 1000))
+                            page = st.number_input(f"**页码:** :green[1~{pages}]", value=1, min_value=1,
+                                                   max_value=pages)
+                            show_padded = pd.DataFrame(padded[(page - 1) * 1000:page * 1000]).rename_axis("序列ID")
+                            show_padded.index = show_padded.index + (page - 1) * 1000 + 1
                         st.dataframe(show_padded, use_container_width=True)
                     with t5:
                         # 补全表状态展示
                         cp1, cp2 = st.columns(spec=2)
                         # 计算每行的长度
                         with cp1:
-                            lengths = np.array([len(np.trim_zeros(row, 'b')) for row in padded])
+                            # 序列中没有0, 补全后的长度就是原长度截断到补全宽度
+                            lengths = np.minimum(sequences.lengths(), padded.shape[1])
                             show_lengths = pd.Series(lengths).rename_axis("序列").rename(index="长度")
                             show_lengths.index = show_lengths.index + 1
                             st.dataframe(show_lengths, use_container_width=True)
@@ -539,8 +561,14 @@ if train_module:
                 # 自定义的回调函数, 包含容器显示和自动保存(覆盖/时间戳命名)
                 streamlit_callback = StreamlitLambdaCallback(tokenizer_map=tokenizer,
                                                              model_name=model_name if rebuild_toggle else None)
-                model.fit(padded, tokenized_data["sentiment"], epochs=epochs, batch_size=batch_size,
-                          validation_split=validation_split,
+                # 从内存映射的补全表和标签流式读取, 随机划分训练/验证集
+                labels = read_labels(path=f"{datapath}/keras",
+                                     mtime=os.path.getmtime(f"{datapath}/keras/labels.npy"))
+                train_dataset, validation_dataset = train_datasets(padded, labels,
+                                                                   validation_split=validation_split,
+                                                                   batch_size=batch_size,
+                                                                   cache="" if cache_dataset else None)
+                model.fit(train_dataset, validation_data=validation_dataset, epochs=epochs,
                           callbacks=[streamlit_callback, reduce_lr, early_stopping])
 
 if use_module:
@@ -570,33 +598,16 @@ if use_module:
                     next_check = False
         else:
             next_check, map_saves = False, False
-        # 读取模型
-        if hadmodel_check:
-            s = time.time()
-            if chosen_model:
-                predict_model = tf.keras.models.load_model(
-                    f"{datapath}/keras/saves/{chosen_model}/{chosen_model}.keras")
-            e = time.time()
+        # 读取模型和映射表-注册表中已有且文件没变化时直接返回
+        if next_check:
+            with st.spinner("加载模型和映射表..."):
+                s = time.time()
+                predict_model = model_registry().get(chosen_model)
+                e = time.time()
             st.success(f"**:orange[{chosen_model}]模型**读取成功: {(e - s):.2f}s", icon='✅')
+            st.success(f"**{':orange[' + chosen_model + ']' if map_saves else '全局'}映射表**加载成功", icon='✅')
         else:
             predict_model = None
-        # 读取映射表
-        if next_check:
-            if map_saves:
-                # 对应文件加载 Tokenizer 对象
-                with st.spinner("加载对应映射表..."):
-                    s = time.time()
-                    predict_tokenizer = read_data(_type="pkl",
-                                                  path=f"{datapath}/keras/saves/{chosen_model}/{chosen_model}.pkl")
-                    e = time.time()
-                st.success(f"**:orange[{chosen_model}]映射表**加载成功: {(e - s):.2f}s", icon='✅')
-            else:
-                # 对应文件加载 Tokenizer 对象
-                with st.spinner("加载全局映射表..."):
-                    s = time.time()
-                    predict_tokenizer = read_data(_type="pkl", path=f"{datapath}/keras/tokenizer.pkl")
-                    e = time.time()
-                st.success(f"**全局映射表加载成功:** {(e - s):.2f}s", icon='✅')
         # 清空历史
         if st.button("清空历史记录", use_container_width=True, type="primary",
                      disabled=chosen_model not in st.session_state):
@@ -605,21 +616,12 @@ if use_module:
     # 模型预测输入
     inputwords = st.chat_input("现在想说点什么?", disabled=not next_check)
     if inputwords:
-        # 使用一个假的输入来编译模型，以触发输入形状的定义
-        fake_input = np.zeros((1, 100))
-        predict_model.predict(fake_input)
-        # 分词
-        cutwords = jieba.lcut(inputwords)
-        # 映射
-        predict_sequences = predict_tokenizer.texts_to_sequences([' '.join(cutwords)])
-        # 补全
-        predict_model_max_length = predict_model.input_shape[1]  # 获取模型字典的参数
-        predict_padded = pad_sequences(predict_sequences, maxlen=predict_model_max_length, padding="post",
-                                       truncating="post")
-        # 输入然后进行预测
-        predict_result = predict_model.predict(predict_padded)
+        # 分词用于展示
+        cutwords = predict_model.cut([inputwords])[0]
+        # 分词 -> 映射 -> 补全 -> 预测, 模型已预热
+        predict_result = predict_model.predict([inputwords])
         # 定义类别标签
-        labels = {0: "消极", 1: "中性", 2: "积极"}
+        labels = LABELS
         color_labels = {0: ":red[消极]", 1: ":grey[中性]", 2: ":green[积极]"}
         show_result = pd.DataFrame(predict_result).rename(columns=labels)
         # 找到最大概率值的索引
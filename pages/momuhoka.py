@@ -1,4 +1,3 @@
-import collections
 import os
 import random
 
@@ -10,9 +9,9 @@ from stqdm import stqdm
 from streamlit_image_select import image_select
 from streamlit_star_rating import st_star_rating
 
-from data.modules import diy_menu, pages_dict, cachepath, read_txt, keys_cache, read_excel, \
-    pie_chart_module, point_chart_module, datapath, word_filter, word_clouds, initialize, init_connection, get_value, \
-    get_values, all_cache, checkcache, film_cache, get_keysCache
+from data.modules import diy_menu, pages_dict, cachepath, keys_cache, \
+    pie_chart_module, point_chart_module, datapath, read_tokens, cloud_image, cloud_renderer, initialize, init_connection, get_value, \
+    film_catalog, all_cache, checkcache, film_cache, get_keysCache, film_key, read_aggregates
 
 # 初始化
 initialize()
@@ -31,18 +30,8 @@ st.set_page_config(
 # 页面菜单
 diy_menu(_page="我的主页", _page_dict=pages_dict)
 
-# 获取封面相关信息
-@st.cache_data
-def get_covers(_db: int):
-    try:
-        with init_connection(db=_db) as _r:
-            result = get_values(_r=_r, keys=[f"电影 : {_} : 封面" for _ in selected_films])
-    except Exception as e:
-        st.error(f"{e}\n数据库连接失败")
-    return result
-
-
-all_data = get_covers(_db=DB)
+# 获取封面相关信息-电影目录和键值缓存的电影顺序一致
+all_data = film_catalog(db=DB).frame().reset_index(drop=True)
 image_urls = all_data["cover"]
 # image_urls = ["https://img3.doubanio.com/view/photo/s_ratio_poster/public/p480747492.webp",
 #               "https://img1.doubanio.com/view/photo/s_ratio_poster/public/p2561716440.webp",
@@ -87,7 +76,7 @@ def get_cover(url: str, _film: str):
 keysCache = get_keysCache(_db=DB)
 
 # 获取电影列表
-films = [filmkey.split(" : ")[1] for filmkey in keysCache["详情"]]
+films = list(keysCache)
 
 selected_films = st.multiselect(label="搜索电影", options=films, default=None)
 if not selected_films:
@@ -129,54 +118,26 @@ with st.sidebar:
             all_cache(_db=DB, _mode=mode)
     # 手动展开
     check = st.checkbox("查看缓存状态", value=False)
-    cache_status = checkcache(film=film)
-    # 展示缓存
+    # 展示缓存-展开时才比较本地和数据库的id
     if check:
-        # 显示缓存状态
+        cache_status = checkcache(db=DB, film=film, keysCache=keysCache)
+        # 显示缓存状态 fresh-最新 stale-缺少部分数据或数据库有更新 missing-没有缓存
         status = pd.DataFrame(cache_status).T \
             .rename_axis(index=film) \
-            .rename(columns={0: "是否缓存", 1: "缓存时间"})
+            .rename(columns={0: "缓存状态", 1: "缓存时间", 2: "本地条数", 3: "清单条数"})
         st.dataframe(status, use_container_width=True)
 
 # 得到电影后就可以开始缓存-放在all_cache之后
 if not mode:
     film_cache(_db=DB, film=film, keysCache=keysCache, mode=False)
-# 图表的基础数据源
-usersDf = read_excel(f"{cachepath}/{film}/用户.xlsx")
-scommsDf = read_excel(f"{cachepath}/{film}/短评.xlsx")
-fcommsDf = read_excel(f"{cachepath}/{film}/长评.xlsx")
-# 评论拼接
-fcommsDf.rename(columns={"full_comment": "comment"}, inplace=True)  # 拼接列名一致
-sandfDf = pd.concat([scommsDf, fcommsDf], axis=0).astype(str)
-comString = '|'.join(sandfDf["comment"].to_list())
-# 用户ip处理
-# 用于判断属地 - 常居地 > IP
-LOCATIONS = ["河北", "山西", "辽宁", "吉林", "黑龙江", "江苏",
-             "浙江", "安徽", "福建", "江西", "山东", "河南",
-             "湖北", "湖南", "广东", "海南", "四川", "贵州",
-             "云南", "陕西", "甘肃", "青海", "台湾", "内蒙古",
-             "广西", "西藏", "宁夏", "新疆", "北京", "天津",
-             "上海", "重庆", "香港", "澳门"]
-# IP异常用location填充
-usersDf["ip"].fillna(usersDf["location"], inplace=True)
-# ip置换
-for ip in usersDf["ip"].astype(str):
-    for pos in LOCATIONS:
-        if pos in ip:
-            usersDf["ip"].replace(ip, pos, inplace=True)
-            break
-# 过滤 nan
-usersDf.dropna(axis=0, how="any", subset=["ip"], inplace=True)
+# 缓存时已经汇总好的图表数据
+aggregates = read_aggregates(film)
 
 with col_1:
     with st.container(border=True):
         st.image(cover_paths[film_index], use_column_width=True)
 with col_2:
-    try:
-        with init_connection(db=DB) as r:
-            value = get_value(_r=r, key=f"电影 : {film} : 详情")
-    except Exception as e:
-        st.error(f"{e}\n数据库连接失败")
+    value = film_catalog(db=DB).get(film)
     col_2_1, col_2_2 = st.columns(spec=[0.7, 0.3])
     with col_2_1:
         st.markdown(f"#### 🎞️{films[film_index]}")
@@ -192,9 +153,9 @@ with col_2:
             if st.button("重新生成词云图",
                          type="primary",
                          use_container_width=True):
-                os.remove(f"{cachepath}/{film}/词云.png")
-                # 清除st.cahce_data的图片缓存
-                word_clouds.clear()
+                # 只清除这部电影的词云, 正在生成时等生成完再清除
+                if not cloud_renderer.invalidate(film):
+                    st.toast("词云图正在生成, 完成后会重新生成", icon="⏳")
     if tab == "简介":
         st.markdown("**🎬成员:**")
         colist = st.columns(spec=12)
@@ -211,60 +172,45 @@ with col_2:
     if tab == "评论":
         colist = st.columns(spec=3)
         if comm_sel == "短评":
-            comm_list = random.sample(keysCache["短评"], 3)
+            comm_list = random.sample(keysCache[film]["短评"], 3)
         else:
-            comm_list = random.sample(keysCache["长评"], 3)
+            comm_list = random.sample(keysCache[film]["长评"], 3)
         for comm, co in zip(comm_list, colist):
             with co:
                 try:
-                    with init_connection(db=DB) as r:
-                        value = get_value(_r=r, key=comm)
+                    r = init_connection(db=DB)
+                    value = get_value(_r=r, key=film_key(film, comm_sel, comm))
                     comment = value["comment"]
                 except KeyError:
                     comment = value["full_comment"]
                 except Exception as e:
                     st.error(f"{e}\n数据库连接失败")
                 with st.container(border=True, height=270):
-                    ui.metric_card(title=f"用户: {comm.split(' : ')[3]}", content=comment,
+                    ui.metric_card(title=f"用户: {comm}", content=comment,
                                    description=f"{value['date']}留言-⭐{value['star']}", key=str(co))
     if tab == "分析":
         tab_1, tab_2, tab_3 = st.tabs(["用户分布饼状图", "用户信息散点图", "影评推荐指数"])
         with tab_1:
-            # 取出对应电影数据 astype-float型转换成str
-            ipList = usersDf["ip"].astype(str).to_list()
-            # 词频统计
-            ip_counts = dict(collections.Counter(ipList))  # 对IP做词频统计
             ipdata = pd.DataFrame({
-                "地域": list(ip_counts.keys()),
-                "数目": list(ip_counts.values())
+                "地域": list(aggregates["地域"].keys()),
+                "数目": list(aggregates["地域"].values())
             })
             with st.expander(f"<{film}>-饼图", expanded=True):
                 fig1 = pie_chart_module(ipdata, "用户评论分布")
                 st.plotly_chart(fig1, use_container_width=True)
         with tab_2:
-            idList = usersDf["id"].astype(str)
-            yearList = usersDf["jointime"].to_list()
-            hadseenList = usersDf["hadseen"].fillna(0).to_list()
-            usersdata = pd.DataFrame({
-                "ID": idList,
-                "IP": ipList,
-                "加入年份": yearList,
-                "估算年份": [int(x[0:4]) + int(x[5:7]) / 12 + int(x[8:10]) / 30 for x in yearList],
-                "看过电影": hadseenList
-            })
+            usersdata = pd.DataFrame(aggregates["散点"])
+            usersdata.insert(3, "估算年份", [int(x[0:4]) + int(x[5:7]) / 12 + int(x[8:10]) / 30
+                                         for x in usersdata["加入年份"]])
             with st.expander(f"<{film}>-散点图", expanded=True):
                 fig2 = point_chart_module(usersdata)
                 st.plotly_chart(fig2, use_container_width=True)
         with tab_3:
             co3, co4 = st.columns(spec=2)
             with co3:
-                starList = scommsDf["star"].astype(str).replace("-1.0", "1.0").tolist()
-                star_map = {"1.0": "很差", "2.0": "较差", "3.0": "还行", "4.0": "推荐", "5.0": "力荐"}
-                starList_mapped = [star_map[star] for star in starList]
-                star_counts = dict(collections.Counter(starList_mapped))
                 star_data = pd.DataFrame({
-                    "星级": list(star_counts.keys()),
-                    "数目": list(star_counts.values())
+                    "星级": list(aggregates["星级"].keys()),
+                    "数目": list(aggregates["星级"].values())
                 })
                 with st.expander(f"<{film}>-饼图", expanded=True):
                     fig_star = pie_chart_module(star_data, "用户评分分布")
@@ -276,44 +222,28 @@ with col_2:
                         'Featured reviews',
                         reviews
                     )
-                    if (option == '短评'):
-                        index1 = scommsDf[scommsDf['star'] == 5.0].index[0]
-                        comment = scommsDf.loc[index1, 'comment']
-                        user_data = scommsDf.loc[index1, '用户']
-                        date_data = scommsDf.loc[index1, 'date']
-                        homepage = scommsDf.loc[index1, 'homepage']
-                        comment_display = f"""{comment}
-
-            Author    :    {user_data}  
-            Date      :    {date_data}
-                            """
-                        st.text_area('', comment_display, height=250)
-                        st.write("If you are interested in this author   ,  here is his homepage:")
-                        st.markdown(homepage)
+                    featured = aggregates["精选"][option]
+                    if featured is None:
+                        st.info("No featured review")
                     else:
-                        index1 = fcommsDf[(fcommsDf['star'] == 5.0) & (fcommsDf['comment'].str.len() < 200)].index[0]
-                        comment = fcommsDf.loc[index1, 'comment']
-                        user_data = fcommsDf.loc[index1, '用户']
-                        date_data = fcommsDf.loc[index1, 'date']
-                        homepage = fcommsDf.loc[index1, 'homepage']
-                        comment_display = f"""{comment}
+                        comment_display = f"""{featured['comment']}
 
-            Author    :    {user_data}  
-            Date      :    {date_data}
-                                            """
-                        st.text_area('', comment_display, height=300)
-                        st.write("If you are interested in this author   ,  here is his homepage:")
-                        st.markdown(homepage)
+            Author    :    {featured['用户']}  
+            Date      :    {featured['date']}
+                            """
+                        st.text_area('', comment_display, height=250 if option == '短评' else 300)
+                        # 没有主页链接就不显示
+                        if featured['homepage']:
+                            st.write("If you are interested in this author   ,  here is his homepage:")
+                            st.markdown(featured['homepage'])
     if tab == "词云":
         if not os.path.isfile(f"{datapath}/new_stopwords.txt"):
             st.markdown(f"# 在{datapath}没有找到new_stopwords.txt文件")
         else:
             co1, co2 = st.columns(spec=[0.6, 0.4])
-            stopwords = read_txt(f"{datapath}/new_stopwords.txt")
-            words = word_filter(comstring=comString, name=film, stopwords=stopwords)
-            # 词频统计
-            word_counts = collections.Counter(words)  # 对分词做词频统计
-            word_counts_top = word_counts.most_common(20)  # 获取最高频的词
+            # 缓存好的词频, 已按频次排序
+            frequencies = read_tokens(film)
+            word_counts_top = list(frequencies.items())[:20]  # 获取最高频的词
             with co2:
                 # 高频词展示
                 wordTop = pd.DataFrame(word_counts_top).rename(
@@ -322,13 +252,5 @@ with col_2:
                 st.info("词云图背景以第一个高频中文词决定", icon="ℹ️")
             with co1:
                 with st.expander(f"<{film}>-词云图", expanded=True):
-                    if not os.path.isfile(f"{cachepath}/{film}/词云.png"):
-                        # 调用函数+缓存
-                        fig = word_clouds(words=words, hotwords=word_counts_top)
-                        st.image(fig)
-                        if not os.path.exists(f"{cachepath}/{film}"):
-                            os.mkdir(f"{cachepath}/{film}")
-                        fig.save(f"{cachepath}/{film}/词云.png")
-                    else:  # 存在词云文件
-                        # 读取词云图
-                        st.image(f"{cachepath}/{film}/词云.png")
+                    # 已生成直接读取, 否则后台生成并显示占位
+                    cloud_image(film=film, frequencies=frequencies)
@@ -1,11 +1,10 @@
 import os
 from time import sleep
 
-import redis
 import streamlit as st
 import pandas as pd
 
-from data.modules import cachepath
+from data.modules import cachepath, init_connection
 from stqdm import stqdm
 
 # data = pd.read_csv("data/douban_top250.txt", delimiter='\t', header=None)
@@ -53,12 +52,12 @@ from stqdm import stqdm
 #         insert2redis(f"电影 : {film} : 封面", dict_list)
 
 # redis数据库
-redis_pool = redis.ConnectionPool(host='175.178.4.58', port=6379, password="momuhoka", db=3)
 films = [_ for _ in os.listdir(cachepath) if not os.path.isfile(f"{cachepath}/{_}")]
 st.table(films)
 new_empty = st.empty()
 if new_empty.button("开始存储", disabled=True):
-    r = redis.Redis(connection_pool=redis_pool)
+    # 图片二进制不需要解码
+    r = init_connection(db=3, decode=False)
     try:
         # pipe = r.pipeline()
         for film in stqdm(films, desc="进度"):
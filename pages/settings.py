@@ -1,12 +1,15 @@
 import os
 import pickle
 import re
+import time
 
 import numpy as np
 import pandas as pd
 import streamlit as st
 
-from data.modules import diy_menu, pages_dict, datapath, cachepath
+from data.modules import diy_menu, pages_dict, datapath, cachepath, storage, read_cache, redis_manager, \
+    stopwords_service, keys_manifest, keys_cache, init_connection, flight_stats, flight_caches, \
+    cache_budget
 
 # 设置全局属性
 st.set_page_config(
@@ -47,15 +50,15 @@ def read_data(_type: str, path: str):
     return _data
 
 
-def create_data(_filespath: list):
+def create_data(_films: list):
     _data = pd.DataFrame()
     # 加载数据集
     holder = st.empty()
-    _length = len(_filespath)
+    _length = len(_films)
     holder.progress(value=0, text=f"数据合成中: 0/{_length}")
-    for index, _filepath in enumerate(_filespath):
+    for index, _film in enumerate(_films):
         holder.progress(value=(index + 1) / _length, text=f"数据合成中: {index + 1}/{_length}")
-        scommsDf = pd.read_excel(f"{_filepath}/短评.xlsx")
+        scommsDf = read_cache(_film, "短评", columns=["用户", "comment", "star"])
         sandfDf = scommsDf.astype(np.str_)
         # 评论处理
         pattern = re.compile(r"[^\u4e00-\u9fa5^a-zA-Z]")  # 需要的字符
@@ -88,10 +91,10 @@ def create_data(_filespath: list):
 # 部署项目展示禁用
 if st.button("合成数据", use_container_width=True, disabled=True):
     walkers = os.listdir(cachepath)
-    filespath = [f"{cachepath}/{walker}" for walker in walkers if not os.path.isfile(f"{cachepath}/{walker}")]
-    # st.write(filespath)
-    vaildpath = [_ for _ in filespath if os.path.isfile(f"{_}/短评.xlsx")]
-    data = create_data(vaildpath)
+    films = [walker for walker in walkers if not os.path.isfile(f"{cachepath}/{walker}")]
+    # st.write(films)
+    vaildfilms = [_ for _ in films if storage.exists(_, "短评")]
+    data = create_data(vaildfilms)
     st.success(f"**已保存至:** :blue[{datapath}/cache.csv] **长度:** :orange[{len(data)}]")
     show_data = data.reset_index(drop=True).rename_axis("序列")
     show_data.index = show_data.index + 1
@@ -105,3 +108,51 @@ if st.button("合成数据", use_container_width=True, disabled=True):
 #     if st.button("保存/覆盖至new_cache.csv", use_container_width=True):
 #         data.to_csv(f"{datapath}/new_cache.csv")
 #         st.success(f"**已保存至:** :blue[{datapath}/new_cache.csv] **长度:** :orange[{len(data)}]")
+
+# 用户停用词, 保存后词频缓存会按文件时间自动重新统计
+with st.expander("**停用词**"):
+    st.dataframe(pd.DataFrame([stopwords_service.stats()]), use_container_width=True, hide_index=True)
+    uploaded = st.file_uploader("导入停用词表(txt, 每行一个)", type=["txt"])
+    user_words = stopwords_service.user_words()
+    if uploaded is not None:
+        user_words += uploaded.getvalue().decode("utf-8").splitlines()
+    text = st.text_area("用户停用词(每行一个)", value='\n'.join(user_words), height=200)
+    if st.button("保存停用词", use_container_width=True):
+        stopwords_service.save_user_words(text.splitlines())
+        st.success(f"**已保存至:** :blue[{stopwords_service.user_path}]")
+
+# 键值清单状态, 数据库键数量变化说明清单过期
+with st.expander("**键值清单**"):
+    manifest = keys_manifest(_db=DB)
+    dbsize = init_connection(db=DB).dbsize()
+    st.dataframe(pd.DataFrame([{
+        "版本": manifest["version"],
+        "第几次生成": manifest["generation"],
+        "生成时间": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["timestamp"])),
+        "电影数": len(manifest["films"]),
+        "生成时键数量": manifest["dbsize"],
+        "当前键数量": dbsize,
+        "是否过期": dbsize != manifest["dbsize"]
+    }]), use_container_width=True, hide_index=True)
+    if st.button("重新下载键值", use_container_width=True):
+        with st.spinner("下载键值中..."):
+            keys_cache(db=DB)
+        st.rerun()
+
+# 数据库连接池状态
+with st.expander("**数据库连接池**"):
+    st.dataframe(redis_manager.stats(), use_container_width=True, hide_index=True)
+
+# 进程内缓存的命中情况和内存占用
+with st.expander("**缓存统计**"):
+    st.dataframe(pd.DataFrame([cache_budget.stats()]), use_container_width=True, hide_index=True)
+    st.dataframe(flight_stats(), use_container_width=True, hide_index=True)
+    # 只对当前进程生效, 重启后恢复为配置的值
+    budget = st.number_input("内存上限(MB)", min_value=16, value=cache_budget.budget // 2 ** 20, step=64,
+                             help="默认值可在secrets.toml的[cache] budget_mb或环境变量CACHE_BUDGET_MB设置")
+    if budget != cache_budget.budget // 2 ** 20:
+        cache_budget.resize(budget * 2 ** 20)
+    if st.button("清空读取缓存", use_container_width=True):
+        for cache in flight_caches.values():
+            cache.clear()
+        st.rerun()